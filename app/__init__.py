@@ -19,7 +19,8 @@ def get_locale():
     #return 'zh_Hans'
     return current_app.config['LANGUAGES'][0]
 
-db = SQLAlchemy()
+from app.routing import RoutingSession
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 migrate = Migrate()
 
 login = LoginManager()
@@ -39,31 +40,73 @@ def create_app(config_class=Config):
 
     db.init_app(app)
     migrate.init_app(app, db)
+    from app import routing
+    routing.init_app(app, db)
+    from app import sqlite
+    sqlite.init_app(app)
+    from app import querycount
+    querycount.init_app(app)
+    from app.metrics import Metrics
+    app.metrics = Metrics(app)
+
+    from app.last_seen import LastSeenBuffer
+    app.last_seen = LastSeenBuffer(app)
+
+    # language detection pool, warmed on the first request of each worker
+    from app.language import LanguageDetector
+    app.language_detector = LanguageDetector(app)
+    app.before_request(app.language_detector.start)
     login.init_app(app)
+    # snapshots of logged-in users, see app/session_user.py
+    from app.session_user import SessionUserCache
+    app.session_users = SessionUserCache(app)
 
     if not app.config.get("EMAIL_ENABLED", True):
         app.config["MAIL_SUPPRESS_SEND"] = True
 
     mail.init_app(app)
     moment.init_app(app)
+
+    from app.fragments import PostFragmentCache
+    app.post_fragments = PostFragmentCache(app)
+    app.jinja_env.globals['render_post'] = app.post_fragments.render
+    # explore's newest posts, loaded on the first request of each worker
+    from app.recent import RecentPosts
+    app.recent_posts = RecentPosts(app)
+    app.before_request(app.recent_posts.start)
     babel.init_app(app, locale_selector=get_locale)
     #app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
         #if app.config['ELASTICSEARCH_URL'] else None
     
+    # connects on first use, never at startup; health checks and a circuit breaker
+    # keep calls from waiting on a cluster that is down, see app/circuit.py
     app.elasticsearch = None
     host = app.config.get('ELASTICSEARCH_URL') or os.environ.get('ELASTIC_HOST')
-
     if host:
-        try:
-            from elasticsearch import Elasticsearch
-            # simple unauth dev (localhost) or managed host without auth
-            app.elasticsearch = Elasticsearch(hosts=[host], request_timeout=5)
-            # sanity check; if it fails we just disable ES
-            app.elasticsearch.info()
-            app.logger.info("Elasticsearch enabled at %s", host)
-        except Exception as e:
-            app.logger.warning("Elasticsearch disabled: %s", e)
-            app.elasticsearch = None
+        from app.circuit import ElasticsearchClient
+        app.elasticsearch = ElasticsearchClient(app, host)
+        app.before_request(app.elasticsearch.start)
+        app.logger.info("Elasticsearch enabled at %s", host)
+
+    # index changes are queued by SearchableMixin and sent in bulk from a background thread
+    from app.background import PeriodicWorker
+    from app.search import drain_outbox
+    app.search_indexer = PeriodicWorker(app, drain_outbox, app.config['SEARCH_OUTBOX_INTERVAL'],
+                                        'search-outbox')
+    if app.elasticsearch is not None:
+        app.before_request(app.search_indexer.start)
+    # Elasticsearch result blocks per query and points in time per index, see app/search.py
+    from app.cache import TTLCache
+    from app.search import PointsInTime
+    app.search_results = TTLCache(1024, app.config['SEARCH_CACHE_TTL'])
+    app.search_pits = PointsInTime(app)
+
+    # outgoing mail is queued in the database and sent by a fixed pool of threads
+    from app.email import drain_outbox as drain_mail
+    app.mail_sender = PeriodicWorker(app, drain_mail, app.config['MAIL_OUTBOX_INTERVAL'],
+                                     'mail-outbox', threads=app.config['MAIL_SENDER_THREADS'])
+    if app.config.get('EMAIL_ENABLED', True) and app.config['MAIL_SERVER']:
+        app.before_request(app.mail_sender.start)
 
     # register blueprint with the application
     from app.errors import bp as errors_bp
@@ -75,6 +118,9 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api')
+
     from app.cli import bp as cli_bp
     app.register_blueprint(cli_bp)
 
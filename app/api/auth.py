@@ -0,0 +1,35 @@
+from functools import wraps
+from flask import g, request
+import sqlalchemy as sa
+from app import db
+from app.models import User
+from app.api.errors import error_response
+
+# views need "Authorization: Bearer <token>", the user is in g.api_user
+def token_auth(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth = request.authorization
+        user = None
+        if auth is not None and auth.type == 'bearer' and auth.token:
+            user = User.check_token(auth.token)
+        if user is None:
+            return error_response(401)
+        g.api_user = user
+        return f(*args, **kwargs)
+    return decorated
+
+# username and password, only used to get a token
+def basic_auth(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth = request.authorization
+        user = None
+        if auth is not None and auth.type == 'basic':
+            user = db.session.scalar(sa.select(User).where(User.username == auth.username))
+        if user is None or user.password_hash is None or \
+                not user.check_password(auth.password or ''):
+            return error_response(401)
+        g.api_user = user
+        return f(*args, **kwargs)
+    return decorated
@@ -0,0 +1,111 @@
+import json
+from flask import current_app, g, request
+import sqlalchemy as sa
+from app import db
+from app.models import User, Post
+from app.pagination import keyset_paginate
+from app.routing import read_only
+from app.search import query_index
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request, error_response
+
+# posts are Core rows of these columns, never ORM objects
+POST_COLUMNS = (Post.id, Post.body, Post.timestamp, Post.language, Post.user_id)
+
+
+def _json(payload, status=200):
+    return current_app.response_class(
+        json.dumps(payload, separators=(',', ':'), ensure_ascii=False),
+        status=status, mimetype='application/json')
+
+def _per_page():
+    try:
+        per_page = int(request.args.get('limit', current_app.config['POSTS_PER_PAGE']))
+    except ValueError:
+        per_page = current_app.config['POSTS_PER_PAGE']
+    return max(1, min(per_page, current_app.config['API_MAX_PER_PAGE']))
+
+# {items: [post], authors: {id: author}, next_cursor, prev_cursor}; each
+# author is sent once per page, fetched with a single query
+def _posts_page(rows, next_cursor, prev_cursor):
+    authors = {}
+    author_ids = {row[4] for row in rows}
+    if author_ids:
+        for id, username, avatar_hash in db.session.execute(
+                sa.select(User.id, User.username, User.avatar_hash)
+                .where(User.id.in_(author_ids))):
+            authors[str(id)] = {
+                'username': username,
+                'avatar': f'https://www.gravatar.com/avatar/{avatar_hash}?d=identicon'}
+    items = [{'id': id, 'body': body, 'timestamp': timestamp.isoformat(timespec='seconds') + 'Z',
+              'language': language or None, 'author': user_id}
+             for id, body, timestamp, language, user_id in rows]
+    return _json({'items': items, 'authors': authors,
+                  'next_cursor': next_cursor, 'prev_cursor': prev_cursor})
+
+def _user_id(username):
+    return db.session.scalar(sa.select(User.id).where(User.username == username))
+
+
+@bp.route('/timeline', methods=['GET'])
+@token_auth
+@read_only
+def timeline():
+    feed = g.api_user.timeline_feed()
+    query = sa.select(*POST_COLUMNS).join(feed, feed.c.post_id == Post.id)
+    page = keyset_paginate(query, (feed.c.timestamp, feed.c.post_id),
+                           request.args.get('cursor'), _per_page(), rows=True)
+    return _posts_page(page.items, page.next_cursor, page.prev_cursor)
+
+@bp.route('/explore', methods=['GET'])
+@token_auth
+@read_only
+def explore():
+    page = keyset_paginate(sa.select(*POST_COLUMNS), (Post.timestamp, Post.id),
+                           request.args.get('cursor'), _per_page(), rows=True)
+    return _posts_page(page.items, page.next_cursor, page.prev_cursor)
+
+@bp.route('/users/<username>/posts', methods=['GET'])
+@token_auth
+@read_only
+def user_posts(username):
+    id = _user_id(username)
+    if id is None:
+        return error_response(404, f'User {username} not found.')
+    page = keyset_paginate(sa.select(*POST_COLUMNS).where(Post.user_id == id),
+                           (Post.timestamp, Post.id), request.args.get('cursor'),
+                           _per_page(), rows=True)
+    return _posts_page(page.items, page.next_cursor, page.prev_cursor)
+
+@bp.route('/search', methods=['GET'])
+@token_auth
+@read_only
+def search():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return bad_request('Missing search query.')
+    ids, next_cursor, prev_cursor = query_index(Post.__tablename__, q, _per_page(),
+                                                request.args.get('cursor'))
+    rows = []
+    if ids:
+        # back in relevance order
+        order = {id: i for i, id in enumerate(ids)}
+        rows = sorted(db.session.execute(sa.select(*POST_COLUMNS).where(Post.id.in_(ids))),
+                      key=lambda row: order[row[0]])
+    return _posts_page(rows, next_cursor, prev_cursor)
+
+@bp.route('/users/<username>/follow', methods=['POST', 'DELETE'])
+@token_auth
+def follow(username):
+    user = db.session.scalar(sa.select(User).where(User.username == username))
+    if user is None:
+        return error_response(404, f'User {username} not found.')
+    if user == g.api_user:
+        return bad_request('You cannot follow yourself.')
+    if request.method == 'POST':
+        g.api_user.follow(user)
+    else:
+        g.api_user.unfollow(user)
+    db.session.commit()
+    return _json({'following': request.method == 'POST', 'followers': user.num_followers})
@@ -0,0 +1,18 @@
+from flask import g
+from app import db
+from app.api import bp
+from app.api.auth import basic_auth, token_auth
+
+@bp.route('/tokens', methods=['POST'])
+@basic_auth
+def get_token():
+    token = g.api_user.get_token()
+    db.session.commit()
+    return {'token': token}
+
+@bp.route('/tokens', methods=['DELETE'])
+@token_auth
+def revoke_token():
+    g.api_user.revoke_token()
+    db.session.commit()
+    return '', 204
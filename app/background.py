@@ -0,0 +1,48 @@
+import os
+import threading
+
+# daemon thread(s) running `target` in an app context every `interval` seconds,
+# or as soon as they are woken. Started lazily so each gunicorn worker gets its own.
+class PeriodicWorker:
+    def __init__(self, app, target, interval, name, threads=1):
+        self.app = app
+        self.target = target
+        self.interval = interval
+        self.name = name
+        self.threads = threads
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        # BACKGROUND_WORKERS is off in tests, which call the target directly
+        if not self.app.config.get('BACKGROUND_WORKERS'):
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            for i in range(self.threads):
+                threading.Thread(target=self._run, name=f'{self.name}-{i}', daemon=True).start()
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                with self.app.app_context():
+                    self.target()
+            except Exception:
+                self.app.logger.exception('%s failed', self.name)
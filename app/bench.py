@@ -0,0 +1,324 @@
+import gc
+import json
+import random
+import re
+import statistics
+import threading
+import tracemalloc
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
+from hashlib import md5
+from itertools import accumulate
+from time import perf_counter
+import sqlalchemy as sa
+from flask import current_app
+from werkzeug.security import generate_password_hash
+from app import db
+from app.models import User, Post, followers
+from app.querycount import QueryCounter
+from app.search import local_index_enabled, rebuild_local_index
+from app import sqlite
+
+# --- synthetic data ---
+
+# share of posts per language, roughly what the live site sees
+LANGUAGE_MIX = {'en': 0.6, 'es': 0.2, 'zh': 0.1, 'fr': 0.05, 'de': 0.05}
+
+PHRASES = {
+    'en': ['just finished a great book', 'the weather is lovely today',
+           'working on a new flask project', 'coffee first then code',
+           'anyone going to the conference next week', 'learning something new every day'],
+    'es': ['hoy hace un tiempo estupendo', 'acabo de terminar un libro genial',
+           'trabajando en un proyecto nuevo', 'primero el cafe y luego el codigo'],
+    'zh': ['今天天气很好', '刚读完一本好书', '正在做一个新项目', '先喝咖啡再写代码'],
+    'fr': ['il fait beau aujourd hui', 'je viens de finir un bon livre',
+           'je travaille sur un nouveau projet'],
+    'de': ['heute ist das wetter schoen', 'ich habe gerade ein tolles buch gelesen',
+           'ich arbeite an einem neuen projekt'],
+}
+
+
+# cumulative weights of a power law over ranks 1..n: a few accounts get most
+# of the follows and write most of the posts
+def _zipf(n, exponent):
+    return list(accumulate(1 / rank ** exponent for rank in range(1, n + 1)))
+
+def _pick(rng, population, cum_weights):
+    x = rng.random() * cum_weights[-1]
+    return population[min(bisect_left(cum_weights, x), len(population) - 1)]
+
+def _insert(table, rows):
+    if rows:
+        db.session.execute(table.insert(), rows)
+
+# bulk-loads users, a power-law follow graph and posts with Core executemany,
+# then rebuilds the derived data (counters, timeline, local search index)
+def seed(users=1000, posts=10000, follows=20, exponent=1.1, days=365, batch_size=5000,
+         random_seed=42, progress=None):
+    rng = random.Random(random_seed)
+    progress = progress or (lambda message: None)
+    first = (db.session.scalar(sa.select(sa.func.max(User.id))) or 0) + 1
+    password_hash = generate_password_hash('bench')
+    now = datetime.now(timezone.utc)
+
+    # ids come from the database (RETURNING) so sequences stay in step
+    rows, ids = [], []
+    insert_users = User.__table__.insert().returning(User.id, sort_by_parameter_order=True)
+    for n in range(first, first + users):
+        email = f'bench{n}@example.com'
+        rows.append({'username': f'bench{n}', 'email': email,
+                     'avatar_hash': md5(email.encode('utf-8')).hexdigest(),
+                     'password_hash': password_hash, 'last_seen': now,
+                     'num_followers': 0, 'num_following': 0, 'num_posts': 0,
+                     'follow_version': 0, 'timeline_pull': False})
+        if len(rows) == batch_size or n == first + users - 1:
+            ids.extend(db.session.scalars(insert_users, rows))
+            rows = []
+    progress(f'{users} users')
+
+    popularity = ids[:]
+    rng.shuffle(popularity)
+    weights = _zipf(users, exponent)
+    rows, edges = [], 0
+    for follower in ids:
+        # follows per user are skewed too: most follow a few, some follow many
+        wanted = min(users - 1, int(rng.paretovariate(1.5) * follows / 3))
+        followed = set()
+        for _ in range(wanted * 2):
+            if len(followed) >= wanted:
+                break
+            user = _pick(rng, popularity, weights)
+            if user != follower:
+                followed.add(user)
+        rows.extend({'follower_id': follower, 'followed_id': user} for user in followed)
+        if len(rows) >= batch_size:
+            _insert(followers, rows)
+            edges += len(rows)
+            rows = []
+    _insert(followers, rows)
+    edges += len(rows)
+    progress(f'{edges} follows')
+
+    languages, language_weights = zip(*LANGUAGE_MIX.items())
+    language_weights = list(accumulate(language_weights))
+    start = now - timedelta(days=days)
+    step = timedelta(days=days) / max(posts, 1)
+    rows = []
+    for i in range(posts):
+        language = _pick(rng, languages, language_weights)
+        rows.append({'body': rng.choice(PHRASES[language])[:140],
+                     'timestamp': start + step * i, 'language': language,
+                     'user_id': _pick(rng, popularity, weights), 'version': 1})
+        if len(rows) == batch_size:
+            _insert(Post.__table__, rows)
+            rows = []
+    _insert(Post.__table__, rows)
+    db.session.commit()
+    progress(f'{posts} posts')
+
+    current_app.recent_posts.invalidate()
+    User.repair_counters()
+    progress(f'{Post.rebuild_timeline()} timeline rows')
+    if local_index_enabled():
+        progress(f'{rebuild_local_index(Post)} documents in the local search index')
+    return users, edges, posts
+
+
+# --- benchmark harness ---
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+def _routes(client):
+    # a reader who follows many people, and the most followed author
+    reader = db.session.scalar(sa.select(User).order_by(User.num_following.desc()).limit(1))
+    author = db.session.scalar(sa.select(User).order_by(User.num_followers.desc()).limit(1))
+    if reader is None or author is None or reader == author:
+        raise RuntimeError('Not enough data, run "flask bench seed" first')
+    word = (db.session.scalar(sa.select(Post.body).limit(1)) or 'the').split()[0]
+    with client.session_transaction() as session:
+        session['_user_id'] = str(reader.id)
+
+    # the first older page, to measure the cost of following a cursor
+    match = re.search(r'cursor=([\w-]+)', client.get('/index').get_data(as_text=True))
+    cursor = match.group(1) if match else None
+    follow = f'/follow/{author.username}'
+    unfollow = f'/unfollow/{author.username}'
+    if reader.is_following(author):
+        follow, unfollow = unfollow, follow
+
+    def toggle_follow():
+        client.post(follow)
+        return client.post(unfollow)
+
+    return {
+        'index': lambda: client.get('/index'),
+        'index_page_2': lambda: client.get('/index', query_string={'cursor': cursor})
+        if cursor else client.get('/index'),
+        'explore': lambda: client.get('/explore'),
+        'user': lambda: client.get(f'/user/{author.username}'),
+        'search': lambda: client.get('/search', query_string={'q': word}),
+        'follow_unfollow': toggle_follow,
+    }
+
+# drives the main routes through the test client; latency is measured without
+# tracemalloc, then a shorter pass records peak memory per request
+def run(requests=100, warmup=5, memory_requests=10, routes=None):
+    app = current_app._get_current_object()
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = app.test_client()
+    available = _routes(client)
+    results = {}
+    for name, request in available.items():
+        if routes and name not in routes:
+            continue
+        for _ in range(warmup):
+            request()
+
+        times, queries = [], []
+        for _ in range(requests):
+            with QueryCounter(db.engine) as counter:
+                start = perf_counter()
+                response = request()
+                # pages are streamed, the time includes reading the whole body
+                response.get_data()
+                times.append(perf_counter() - start)
+            queries.append(counter.count)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{name} returned {response.status_code}')
+
+        gc.collect()
+        tracemalloc.start()
+        peaks = []
+        for _ in range(memory_requests):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            request().get_data()
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        tracemalloc.stop()
+
+        results[name] = {
+            'p50_ms': _percentile(times, 50) * 1000,
+            'p95_ms': _percentile(times, 95) * 1000,
+            'p99_ms': _percentile(times, 99) * 1000,
+            'queries': statistics.mean(queries),
+            'max_queries': max(queries),
+            'peak_kib': max(peaks) / 1024 if peaks else 0,
+        }
+    return {
+        'users': db.session.scalar(sa.select(sa.func.count(User.id))),
+        'posts': db.session.scalar(sa.select(sa.func.count(Post.id))),
+        'requests': requests,
+        'routes': results,
+    }
+
+def format_report(report, baseline=None):
+    lines = [f"{report['users']} users, {report['posts']} posts, "
+             f"{report['requests']} requests per route",
+             f"{'route':<16}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'peak KiB':>10}"]
+    for name, r in report['routes'].items():
+        line = (f"{name:<16}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+                f"{r['queries']:>9.1f}{r['peak_kib']:>10.0f}")
+        old = (baseline or {}).get('routes', {}).get(name)
+        if old:
+            line += f"   p95 {_change(old['p95_ms'], r['p95_ms'])}, " \
+                    f"queries {_change(old['queries'], r['queries'])}"
+        lines.append(line)
+    return '\n'.join(lines)
+
+def _change(old, new):
+    if not old:
+        return 'n/a'
+    return f'{(new - old) / old * 100:+.0f}%'
+
+# routes whose p95 grew by more than `tolerance` (a fraction) or that now
+# issue more queries than the baseline
+def regressions(report, baseline, tolerance=0.2):
+    found = []
+    for name, r in report['routes'].items():
+        old = baseline.get('routes', {}).get(name)
+        if old is None:
+            continue
+        if r['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+            found.append(f"{name}: p95 {old['p95_ms']:.2f}ms -> {r['p95_ms']:.2f}ms")
+        if r['max_queries'] > old['max_queries']:
+            found.append(f"{name}: queries {old['max_queries']} -> {r['max_queries']}")
+    return found
+
+def save(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# --- SQLite concurrency ---
+
+# mixed read/write load from `threads` threads against a scratch SQLite file,
+# with or without the production profile (pragmas + writer lock)
+def sqlite_stress(path, threads=16, seconds=5, write_ratio=0.2, production=True):
+    engine = sa.create_engine(f'sqlite:///{path}', pool_size=threads, max_overflow=0)
+    if production:
+        config = current_app.config
+        sqlite.configure_engine(engine, sqlite.pragmas(config),
+                                sqlite.WriterLock(config['SQLITE_WRITE_LOCK_TIMEOUT']))
+    metadata = sa.MetaData()
+    table = sa.Table('stress', metadata,
+                     sa.Column('id', sa.Integer, primary_key=True),
+                     sa.Column('n', sa.Integer, nullable=False),
+                     sa.Column('body', sa.String(140), nullable=False))
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(table.insert(), [{'n': 0, 'body': 'x' * 100} for _ in range(1000)])
+
+    deadline = perf_counter() + seconds
+    lock = threading.Lock()
+    totals = {'reads': 0, 'writes': 0, 'errors': 0}
+    write_times = []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        counts = {'reads': 0, 'writes': 0, 'errors': 0}
+        times = []
+        while perf_counter() < deadline:
+            id = rng.randint(1, 1000)
+            try:
+                if rng.random() < write_ratio:
+                    start = perf_counter()
+                    with engine.begin() as conn:
+                        conn.execute(table.insert().values(n=0, body='y' * 100))
+                        conn.execute(table.update().where(table.c.id == id)
+                                     .values(n=table.c.n + 1))
+                    times.append(perf_counter() - start)
+                    counts['writes'] += 1
+                else:
+                    with engine.connect() as conn:
+                        conn.execute(sa.select(table).where(table.c.id == id)).one()
+                    counts['reads'] += 1
+            except sa.exc.OperationalError:
+                counts['errors'] += 1
+        with lock:
+            for key, value in counts.items():
+                totals[key] += value
+            write_times.extend(times)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = perf_counter() - started
+    engine.dispose()
+    return {
+        'profile': 'production' if production else 'default',
+        'reads_per_s': totals['reads'] / elapsed,
+        'writes_per_s': totals['writes'] / elapsed,
+        'errors': totals['errors'],
+        'write_p95_ms': _percentile(write_times, 95) * 1000 if write_times else 0,
+        'write_p99_ms': _percentile(write_times, 99) * 1000 if write_times else 0,
+    }
@@ -0,0 +1,174 @@
+import threading
+from functools import partial
+from time import monotonic
+from app.background import PeriodicWorker
+
+# Circuit breaker for an external service, one per worker process. Closed, calls
+# go through; after `threshold` failures in a row it opens and calls fail with
+# CircuitOpen without touching the network. Once `reset_timeout` seconds have
+# passed a single trial call is let through (half-open): success closes the
+# breaker, failure opens it again. Transitions are logged and exported on
+# /metrics.
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+# what a failed call says about Elasticsearch: True, it answered (a 4xx status);
+# False, it is unreachable or failing; None, the error is ours (TypeError, ...)
+def _elasticsearch_outcome(error):
+    from elasticsearch import ApiError, TransportError
+    if isinstance(error, TransportError):
+        return False
+    if isinstance(error, ApiError):
+        return error.status_code < 500
+    return None
+
+
+class CircuitBreaker:
+    def __init__(self, app, name, threshold, reset_timeout, classify):
+        self.app = app
+        self.name = name
+        self.classify = classify  # error -> True (service up), False (down) or None
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0  # in a row
+        self.opened_at = 0.0
+        self._trial = False  # the half-open trial call is in flight
+        self._lock = threading.Lock()
+        self._set_metric('microblog_circuit_open', 0)
+
+    # lock-free: whether a call now would be let through, for `if es:`
+    def available(self):
+        return self.state != OPEN or monotonic() - self.opened_at >= self.reset_timeout
+
+    def call(self, f, *args, **kwargs):
+        self._enter()
+        try:
+            result = f(*args, **kwargs)
+        except Exception as e:
+            self.record(e)
+            raise
+        self.record()
+        return result
+
+    # the outcome of a call, or of a health check made outside call()
+    def record(self, error=None):
+        outcome = True if error is None else self.classify(error)
+        with self._lock:
+            self._trial = False
+            if outcome is None:
+                return
+            if outcome:
+                self.failures = 0
+                if self.state != CLOSED:
+                    self._change(CLOSED)
+                return
+            self.failures += 1
+            if self.state == OPEN:
+                self.opened_at = monotonic()
+            elif self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.opened_at = monotonic()
+                self._change(OPEN, error)
+
+    # a call turned away without reaching the service
+    def reject(self):
+        self._set_metric('microblog_circuit_rejected_total', 1, add=True)
+
+    def _enter(self):
+        with self._lock:
+            if self.state == OPEN and monotonic() - self.opened_at >= self.reset_timeout:
+                self._change(HALF_OPEN)
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+            state = self.state
+        self.reject()
+        raise CircuitOpen(f'{self.name} circuit breaker is {state}')
+
+    def _change(self, state, error=None):
+        self.state = state
+        if state == OPEN:
+            self.app.logger.warning('%s circuit breaker opened after %d failure(s): %s',
+                                    self.name, self.failures, error)
+        else:
+            self.app.logger.info('%s circuit breaker %s', self.name, state)
+        self._set_metric('microblog_circuit_open', int(state != CLOSED))
+
+    def _set_metric(self, name, value, add=False):
+        metrics = getattr(self.app, 'metrics', None)
+        if metrics is not None and self.app.config['METRICS_ENABLED']:
+            metrics.set_value(name, self.name, value, add=add)
+
+
+# passes every method call through the breaker; anything that is not callable is
+# a namespace (es.indices, ...) and is wrapped in turn
+class _Guarded:
+    def __init__(self, target, breaker):
+        self._target = target
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if callable(value):
+            return partial(self._breaker.call, value)
+        return _Guarded(value, self._breaker)
+
+
+# app.elasticsearch: the client is created on first use and a background thread
+# checks the cluster every ELASTICSEARCH_HEALTH_INTERVAL seconds, which also
+# closes the breaker again after an outage. False while the breaker is open, so
+# `if es:` sends callers to their fallback path right away
+class ElasticsearchClient:
+    def __init__(self, app, url, factory=None):
+        self.app = app
+        self.url = url
+        self.factory = factory or self._connect
+        self.breaker = CircuitBreaker(app, 'elasticsearch',
+                                      app.config['ELASTICSEARCH_FAILURE_THRESHOLD'],
+                                      app.config['ELASTICSEARCH_RESET_TIMEOUT'],
+                                      _elasticsearch_outcome)
+        self.health = PeriodicWorker(app, self.check, app.config['ELASTICSEARCH_HEALTH_INTERVAL'],
+                                     'elasticsearch-health')
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        from elasticsearch import Elasticsearch
+        return Elasticsearch(hosts=[self.url],
+                             request_timeout=self.app.config['ELASTICSEARCH_TIMEOUT'])
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self.factory()
+        return self._client
+
+    def start(self):
+        self.health.start()
+
+    def check(self):
+        try:
+            self.client.info()
+        except Exception as e:
+            self.breaker.record(e)
+        else:
+            self.breaker.record()
+
+    # a False here is the usual fast path to the fallback, counted as a rejection
+    def __bool__(self):
+        if self.breaker.available():
+            return True
+        self.breaker.reject()
+        return False
+
+    def __getattr__(self, name):
+        return getattr(_Guarded(self.client, self.breaker), name)
@@ -1,6 +1,14 @@
 import os
-from flask import Blueprint
+from multiprocessing import Pool
+from flask import Blueprint, current_app
 import click
+import sqlalchemy as sa
+from app import db
+from app import bench as benchmarks
+from app.email import drain_outbox as drain_mail
+from app.language import detect_languages, warm_up
+from app.models import User, Post, bump_content_version
+from app.search import rebuild_local_index
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
@@ -33,4 +41,153 @@ def init(lang):
     if os.system(
             'pybabel init -i messages.pot -d app/translations -l ' + lang):
         raise RuntimeError('init command failed')
-    os.remove('messages.pot')
\ No newline at end of file
+    os.remove('messages.pot')
+
+@bp.cli.group()
+def counters():
+    """Denormalized counter commands."""
+    pass
+
+@counters.command()
+def repair():
+    """Recompute follower, following and post counters."""
+    fixed = User.repair_counters()
+    click.echo(f'{fixed} user(s) repaired')
+
+
+@bp.cli.group()
+def search():
+    """Search index commands."""
+    pass
+
+@search.command()
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Rows fetched and documents sent per bulk request.')
+@click.option('--concurrency', default=4, show_default=True,
+              help='Bulk requests in flight.')
+@click.option('--swap', is_flag=True,
+              help='Build a new index and point the alias at it when done.')
+@click.option('--target', help='Index to build (default: post_<timestamp> with --swap).')
+@click.option('--resume', is_flag=True,
+              help='Continue after the last id recorded in the target index.')
+@click.option('--local', is_flag=True,
+              help='Rebuild the SQLite full-text index instead of Elasticsearch.')
+def reindex(chunk_size, concurrency, swap, target, resume, local):
+    """Rebuild the posts search index."""
+    if local:
+        click.echo(f'Indexed {rebuild_local_index(Post)} documents locally')
+        return
+
+    def progress(count, last_id, elapsed):
+        click.echo(f'{count} documents, {count / max(elapsed, 1e-6):.0f} docs/s, '
+                   f'last id {last_id}')
+
+    target, count = Post.reindex(chunk_size=chunk_size, concurrency=concurrency,
+                                 swap=swap, target=target, resume=resume,
+                                 progress=progress)
+    click.echo(f'Indexed {count} documents into {target}')
+
+@bp.cli.group()
+def language():
+    """Post language commands."""
+    pass
+
+@language.command()
+@click.option('--processes', default=os.cpu_count(), show_default=True,
+              help='Detector processes.')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Posts per detector task and UPDATE.')
+def backfill(processes, batch_size):
+    """Detect the language of posts that have none."""
+    query = sa.select(Post.id, Post.body).where(Post.language.is_(None)) \
+        .order_by(Post.id).execution_options(yield_per=batch_size)
+    batches = (list(rows) for rows in db.session.execute(query).partitions())
+    stmt = sa.update(Post).where(Post.id == sa.bindparam('post_id')) \
+        .values(language=sa.bindparam('lang'))
+    count = 0
+    # detection runs in the pool, only this process writes
+    with Pool(processes, initializer=warm_up) as pool:
+        for results in pool.imap(detect_languages, batches):
+            with db.engine.begin() as conn:
+                conn.execute(stmt, [{'post_id': id, 'lang': lang} for id, lang in results])
+                # pages show a Translate link for the new languages
+                bump_content_version(conn)
+            count += len(results)
+            click.echo(f'{count} posts updated')
+    current_app.recent_posts.invalidate()
+
+@bp.cli.group()
+def mail():
+    """Email outbox commands."""
+    pass
+
+@mail.command()
+def drain():
+    """Send all queued emails that are due."""
+    sent = drain_mail()
+    click.echo(f'Sent {sent} emails')
+
+@bp.cli.group()
+def bench():
+    """Synthetic data and benchmark commands."""
+    pass
+
+@bench.command()
+@click.option('--users', default=1000, show_default=True)
+@click.option('--posts', default=10000, show_default=True)
+@click.option('--follows', default=20, show_default=True,
+              help='Typical number of accounts each user follows.')
+@click.option('--exponent', default=1.1, show_default=True,
+              help='Power-law exponent of author popularity.')
+@click.option('--batch-size', default=5000, show_default=True,
+              help='Rows per executemany.')
+@click.option('--seed', 'random_seed', default=42, show_default=True)
+def seed(users, posts, follows, exponent, batch_size, random_seed):
+    """Bulk-insert synthetic users, follows and posts."""
+    benchmarks.seed(users=users, posts=posts, follows=follows, exponent=exponent,
+                    batch_size=batch_size, random_seed=random_seed, progress=click.echo)
+
+@bench.command()
+@click.option('--requests', default=100, show_default=True, help='Timed requests per route.')
+@click.option('--route', 'routes', multiple=True, help='Only run these routes.')
+@click.option('--save', 'save_path', type=click.Path(dir_okay=False),
+              help='Write the results to a baseline file.')
+@click.option('--compare', 'baseline_path', type=click.Path(exists=True, dir_okay=False),
+              help='Compare against a saved baseline, exit 1 on regressions.')
+@click.option('--tolerance', default=0.2, show_default=True,
+              help='Allowed p95 growth over the baseline, as a fraction.')
+def run(requests, routes, save_path, baseline_path, tolerance):
+    """Time the main routes through the test client."""
+    report = benchmarks.run(requests=requests, routes=routes)
+    baseline = benchmarks.load(baseline_path) if baseline_path else None
+    click.echo(benchmarks.format_report(report, baseline))
+    if save_path:
+        benchmarks.save(report, save_path)
+    if baseline:
+        found = benchmarks.regressions(report, baseline, tolerance)
+        for line in found:
+            click.echo(f'REGRESSION {line}')
+        if found:
+            raise SystemExit(1)
+
+@bench.command('sqlite')
+@click.option('--threads', default=16, show_default=True)
+@click.option('--seconds', default=5, show_default=True)
+@click.option('--write-ratio', default=0.2, show_default=True)
+@click.option('--path', default='sqlite-stress.db', show_default=True,
+              type=click.Path(dir_okay=False), help='Scratch database file, overwritten.')
+def sqlite_stress(threads, seconds, write_ratio, path):
+    """Compare SQLite throughput with and without the production profile."""
+    click.echo(f"{'profile':<12}{'reads/s':>10}{'writes/s':>10}{'errors':>8}"
+               f"{'write p95 ms':>14}{'write p99 ms':>14}")
+    for production in (False, True):
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        r = benchmarks.sqlite_stress(path, threads=threads, seconds=seconds,
+                                     write_ratio=write_ratio, production=production)
+        click.echo(f"{r['profile']:<12}{r['reads_per_s']:>10.0f}{r['writes_per_s']:>10.0f}"
+                   f"{r['errors']:>8}{r['write_p95_ms']:>14.1f}{r['write_p99_ms']:>14.1f}")
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
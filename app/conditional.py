@@ -0,0 +1,66 @@
+import time
+from datetime import datetime, timezone
+from hashlib import sha1
+from flask import current_app, g, request, session
+from flask_login import current_user
+
+# conditional GET for rendered pages: a view passes a cheap fingerprint of
+# what it is about to render and gets a 304 back if the client has it already.
+# Newest post ids alone are not enough, pages also show author names, avatars
+# and detected languages: views add models.content_version_column() (or the explore
+# buffer's version), which changes with those. A last_modified for If-Modified-Since
+# has to move with them as well
+
+
+def _etag(parts, csrf):
+    # the viewer's name is in the navbar (and "Hi, ...")
+    username = current_user.username if current_user.is_authenticated else None
+    key = [request.full_path, g.get('locale'), current_user.get_id(), username, parts]
+    if csrf:
+        # the page embeds a CSRF token, don't serve it past its expiry
+        limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+        key.append(session.get('csrf_token'))
+        if limit:
+            key.append(int(time.time() // (limit / 2)))
+    return sha1(repr(key).encode('utf-8')).hexdigest()
+
+# returns a 304 response, or None after remembering the validators for
+# add_validators(); pages with pending flashed messages are always rendered
+def not_modified(*parts, last_modified=None, csrf=False):
+    if request.method != 'GET' or session.get('_flashes'):
+        return None
+    g.etag = _etag(parts, csrf)
+    if last_modified is not None:
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+        # HTTP dates have one second resolution, another change within this second
+        # would keep the same date: don't hand it out yet
+        if last_modified.replace(microsecond=0) >= \
+                datetime.now(timezone.utc).replace(microsecond=0):
+            last_modified = None
+    g.last_modified = last_modified
+
+    if request.if_none_match:
+        matched = request.if_none_match.contains(g.etag)
+    elif last_modified is not None and request.if_modified_since:
+        matched = last_modified.replace(microsecond=0) <= request.if_modified_since
+    else:
+        matched = False
+    if not matched:
+        return None
+    return add_validators(current_app.response_class(status=304))
+
+# after_request: attach the validators computed by not_modified()
+def add_validators(response):
+    etag = g.pop('etag', None)
+    last_modified = g.pop('last_modified', None)
+    if etag is None or response.status_code not in (200, 304):
+        return response
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # per-viewer pages, browsers revalidate on every use
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
@@ -1,20 +1,88 @@
+import smtplib
 from flask_mail import Message
 from flask import current_app
-from app import mail
-from threading import Thread #  running asynchronous tasks - return immediately
-    
-def send_async_email(app, msg): # runs in a background thread
-    with app.app_context(): # pushes a Flask application context in that thread
-        mail.send(msg)
+from app import db, mail
+from app.outbox import claim, dead_letter, done, retry_later
+from app.metrics import external_call
+
+# problems with one message; anything else means the connection is unusable
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                  smtplib.SMTPDataError)
+
+
+# 5xx replies: the server will refuse the message again. Errors that are not
+# SMTP replies come from the message itself (a bad header, an encoding error)
+# and repeat just the same
+def _permanent(error):
+    if not isinstance(error, smtplib.SMTPException):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, message in error.recipients.values()]
+    else:
+        codes = [error.smtp_code]
+    return bool(codes) and all(500 <= code < 600 for code in codes)
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     if not current_app.config.get("EMAIL_ENABLED", True) or not current_app.config.get("MAIL_SERVER"):
         current_app.logger.info("Email disabled; skipping send. subject=%r to=%r", subject, recipients)
         return
-    
-    msg = Message(subject, sender=sender, recipients=recipients)
-    msg.body = text_body
-    msg.html = html_body
-    Thread(target=send_async_email, args=(current_app._get_current_objext(), msg)).start()
 
+    from app.models import EmailOutbox  # local import to avoid circulars
+    # persisted first, sent by the mail-outbox worker pool
+    db.session.add(EmailOutbox(subject=subject, sender=sender, recipients=list(recipients),
+                               text_body=text_body, html_body=html_body))
+    db.session.commit()
+    current_app.mail_sender.wake()
+
+
+def _message(row):
+    msg = Message(row.subject, sender=row.sender, recipients=row.recipients)
+    msg.body = row.text_body
+    msg.html = row.html_body
+    return msg
+
+# counts the attempt: retried later, or dead-lettered if it can never succeed
+def _failed(row, error):
+    if _permanent(error) or row.attempts + 1 >= current_app.config['MAIL_MAX_ATTEMPTS']:
+        current_app.logger.error("Email %s to %s failed, giving up: %r",
+                                 row.id, row.recipients, error)
+        dead_letter([row], error)
+    else:
+        current_app.logger.warning("Email %s to %s failed, will retry: %r",
+                                   row.id, row.recipients, error)
+        retry_later([row], error)
+
+# sends due messages in batches of MAIL_OUTBOX_BATCH, one SMTP connection per batch
+def drain_outbox():
+    from app.models import EmailOutbox  # local import to avoid circulars
+    sent = 0
+    while True:
+        rows = claim(EmailOutbox, current_app.config['MAIL_OUTBOX_BATCH'])
+        if not rows:
+            return sent
+
+        pending = list(rows)
+        try:
+            with external_call('smtp'), mail.connect() as conn:
+                while pending:
+                    row = pending[0]
+                    try:
+                        conn.send(_message(row))
+                    except MESSAGE_ERRORS as e:
+                        _failed(row, e)
+                    except (smtplib.SMTPException, OSError):
+                        raise  # the connection, handled below
+                    except Exception as e:
+                        # otherwise the lease expires and the row is claimed forever
+                        _failed(row, e)
+                    else:
+                        done([row])
+                        sent += 1
+                    pending.pop(0)
+        except (smtplib.SMTPException, OSError) as e:
+            current_app.logger.warning("SMTP connection failed, will retry: %s", e)
+            retry_later(pending, e)
+            db.session.commit()
+            return sent
+        db.session.commit()
@@ -0,0 +1,96 @@
+import json
+import os
+import tempfile
+from flask import g, render_template
+from markupsafe import Markup
+from app.cache import LRUCache
+
+
+class NullBackend:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+
+class MemoryBackend:
+    def __init__(self, maxsize):
+        self._cache = LRUCache(maxsize)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+
+# one small JSON file per entry, shared by all workers on the host
+class FileBackend:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.replace(':', '-') + '.json')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        # write then rename, readers never see half a file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(value, f)
+        os.replace(tmp, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+# rendered _post.html per (post, locale). The entry carries everything else
+# the fragment depends on (post version and language, author name and avatar),
+# so edits, late language detection and username changes re-render on their own
+class PostFragmentCache:
+    def __init__(self, app):
+        self.locales = app.config['LANGUAGES']
+        kind = app.config['POST_FRAGMENT_CACHE']
+        if kind == 'memory':
+            self.backend = MemoryBackend(app.config['POST_FRAGMENT_CACHE_SIZE'])
+        elif kind == 'filesystem':
+            self.backend = FileBackend(app.config['POST_FRAGMENT_CACHE_DIR'] or
+                                       os.path.join(app.instance_path, 'fragments'))
+        else:
+            self.backend = NullBackend()
+
+    @staticmethod
+    def _stamp(post):
+        return [post.version, post.language, post.author.username, post.author.avatar_hash]
+
+    def render(self, post):
+        key = f'post:{post.id}:{g.locale}'
+        stamp = self._stamp(post)
+        entry = self.backend.get(key)
+        if entry is not None and entry['stamp'] == stamp:
+            return Markup(entry['html'])
+        html = render_template('_post.html', post=post)
+        self.backend.set(key, {'stamp': stamp, 'html': html})
+        return Markup(html)
+
+    def forget(self, post_ids):
+        for id in post_ids:
+            for locale in self.locales:
+                self.backend.delete(f'post:{id}:{locale}')
@@ -0,0 +1,80 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import sqlalchemy as sa
+from langdetect import DetectorFactory, detect, LangDetectException #detect and store language
+from langdetect.detector_factory import init_factory
+from app import db
+from app.cache import LRUCache
+
+# langdetect is random by default, the same text should always get the same answer
+DetectorFactory.seed = 0
+
+_cache = LRUCache(4096)
+
+# cached by body hash; '' means undetectable, so it is not retried
+def detect_language(text):
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    language = _cache.get(key)
+    if language is None:
+        try:
+            language = detect(text)[:5]
+        except LangDetectException:
+            language = ''
+        _cache.set(key, language)
+    return language
+
+# for the backfill process pool: [(id, body)] -> [(id, language)]
+def detect_languages(rows):
+    return [(id, detect_language(body)) for id, body in rows]
+
+def warm_up():
+    # loads all language profiles, the slow part of the first detect()
+    DetectorFactory.seed = 0
+    init_factory()
+
+
+# fills Post.language off the request path; posts are committed with
+# language=NULL and updated by a per-worker thread pool
+class LanguageDetector:
+    def __init__(self, app):
+        self.app = app
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if not self.app.config.get('BACKGROUND_WORKERS'):
+            return None
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.app.config['LANGDETECT_WORKERS'],
+                    thread_name_prefix='langdetect')
+                self._executor.submit(warm_up)
+        return self._executor
+
+    def submit(self, post_id, body):
+        executor = self.start()
+        if executor is None:
+            # BACKGROUND_WORKERS off (tests): detect inline
+            return self.fill(post_id, body)
+        executor.submit(self.fill, post_id, body)
+
+    def fill(self, post_id, body):
+        from app.models import Post, bump_content_version  # local import to avoid circulars
+        language = detect_language(body)
+        try:
+            with self.app.app_context():
+                result = db.session.execute(
+                    sa.update(Post).where(Post.id == post_id, Post.language.is_(None))
+                    .values(language=language).execution_options(synchronize_session=False))
+                if result.rowcount:
+                    # the Translate link depends on it
+                    bump_content_version(db.session.connection())
+                db.session.commit()
+                self.app.recent_posts.apply([('language', post_id, language)])
+        except Exception:
+            self.app.logger.exception('Language detection for post %s failed', post_id)
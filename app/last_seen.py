@@ -0,0 +1,89 @@
+import atexit
+import threading
+import weakref
+from datetime import datetime, timedelta, timezone
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from app import db
+from app.background import PeriodicWorker
+
+
+def _aware(value):
+    # SQLite hands back naive datetimes, they are stored as UTC
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+# buffers still alive at interpreter exit get one last flush; a single hook per
+# process, apps that are gone (e.g. from tests) drop out of the set
+_buffers = weakref.WeakSet()
+
+@atexit.register
+def _flush_all_at_exit():
+    for buffer in list(_buffers):
+        buffer._flush_at_exit()
+
+# coalesces last_seen updates in memory and writes them in one bulk UPDATE,
+# so ordinary page views never open a write transaction
+class LastSeenBuffer:
+    def __init__(self, app):
+        self.app = app
+        self.granularity = timedelta(seconds=app.config['LAST_SEEN_GRANULARITY'])
+        self.threshold = app.config['LAST_SEEN_FLUSH_THRESHOLD']
+        self._pending = {}
+        # last values written, within the granularity: a cached session snapshot
+        # still shows what was loaded before the flush
+        self._written = {}
+        self._lock = threading.Lock()
+        self.worker = PeriodicWorker(app, self.flush, app.config['LAST_SEEN_FLUSH_INTERVAL'],
+                                     'last-seen-flush')
+        _buffers.add(self)
+
+    def touch(self, user):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            seen = max(filter(None, (_aware(user.last_seen), self._pending.get(user.id),
+                                     self._written.get(user.id))), default=None)
+            if seen is not None and now - seen < self.granularity:
+                return
+            self._pending[user.id] = now
+            full = len(self._pending) >= self.threshold
+        # show the new value for the rest of this request without dirtying the session
+        # (a cached SessionUser keeps its snapshot)
+        if sa.inspect(user, raiseerr=False) is not None:
+            so.attributes.set_committed_value(user, 'last_seen', now)
+        self.worker.start()
+        if full:
+            self.worker.wake()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        from app.models import User
+        try:
+            db.session.execute(sa.update(User), [
+                {'id': id, 'last_seen': seen} for id, seen in pending.items()])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # keep the values for the next attempt unless newer ones arrived
+            with self._lock:
+                for id, seen in pending.items():
+                    self._pending.setdefault(id, seen)
+            raise
+        cutoff = datetime.now(timezone.utc) - self.granularity
+        with self._lock:
+            self._written = {id: seen for id, seen in self._written.items() if seen > cutoff}
+            self._written.update(pending)
+        return len(pending)
+
+    def _flush_at_exit(self):
+        if not self._pending:
+            return
+        try:
+            with self.app.app_context():
+                self.flush()
+        except Exception:
+            self.app.logger.exception('last_seen flush at exit failed')
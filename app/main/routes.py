@@ -3,102 +3,146 @@ from app import db
 
 from flask_login import current_user, login_required
 import sqlalchemy as sa
-
-from datetime import datetime, timezone
+import sqlalchemy.orm as so
 
 from flask_babel import lazy_gettext as _l
 from flask_babel import _, get_locale
-from langdetect import detect, LangDetectException #detect and store language
-from app.models import User, Post
+from app.models import User, Post, content_version_column, content_changed_column
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm
-from app.translate import translate
+from app.translate import translate, translate_many
+from app.pagination import KeysetStream, PageURL
+from app.conditional import not_modified, add_validators
+from app.routing import read_only
+from app.streaming import stream_page
 from app.main import bp
+from app.api.errors import bad_request
+
+bp.after_app_request(add_validators)
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        # buffered, flushed in bulk by a background thread
+        current_app.last_seen.touch(current_user._get_current_object())
         #  Flask invokes the view function that handles the requested URL
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
+# a page of posts fetched while the template renders them, see app/streaming.py
+def stream_posts(query, key, cursor):
+    return KeysetStream(query, key, cursor, current_app.config['POSTS_PER_PAGE'],
+                        current_app.config['POSTS_STREAM_BATCH'])
+
 @bp.route('/', methods=['GET', 'POST']) # GET shows the page, POST process the form
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required # blocks access unless logged in
+@read_only
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
-
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, user_id=current_user.id)
         db.session.add(post)
         db.session.commit()
+        # language is filled in by a background pool, see app/language.py
+        current_app.language_detector.submit(post.id, post.body)
         flash(_l('Your post is now live!'))
         return redirect(url_for('main.index'))
     
-    page = request.args.get('page', 1, type=int)
-    # shows limit posts at a time
-    posts = db.paginate(current_user.following_posts(), page=page, 
-                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
-        if posts.has_prev else None
-    
-    return render_template('index.html', title=_l('Home Page'), form=form, posts=posts.items, 
-                           next_url=next_url, prev_url=prev_url)
+    # newest entry of the feed and the content version, one statement
+    newest = current_user.timeline_latest()
+    latest = db.session.execute(
+        sa.select(newest.c.post_id, newest.c.timestamp, content_version_column()).order_by(
+            newest.c.timestamp.desc(), newest.c.post_id.desc()).limit(1)).first()
+    response = not_modified(tuple(latest or ()), current_user.follow_version, csrf=True)
+    if response is not None:
+        return response
+
+    cursor = request.args.get('cursor')
+    feed = current_user.timeline_feed()
+    # shows limit posts at a time, keyed on the timeline index
+    query = sa.select(Post).join(feed, feed.c.post_id == Post.id).options(
+        so.selectinload(Post.author))
+    posts = stream_posts(query, (feed.c.timestamp, feed.c.post_id), cursor)
+    return stream_page('index.html', title=_l('Home Page'), form=form, posts=posts,
+                       next_url=PageURL(posts, 'next_cursor', 'main.index'),
+                       prev_url=PageURL(posts, 'prev_cursor', 'main.index'))
 
 @bp.route('/explore')
 @login_required
+@read_only
 def explore():
-    page = request.args.get(_l('page'), 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
-        if posts.has_prev else None
-    
-    return render_template('index.html', title=_l('Explore'), posts=posts.items, 
-                           next_url=next_url, prev_url=prev_url)
+    recent = current_app.recent_posts.current()
+    # Last-Modified has to move with the version too, not just with new posts
+    if recent is not None:
+        latest = recent.latest
+        version = recent.version
+        modified = recent.modified
+    else:
+        latest = db.session.execute(
+            sa.select(Post.id, Post.timestamp, content_version_column(),
+                      content_changed_column())
+            .order_by(Post.id.desc()).limit(1)).first()
+        version = None
+        modified = max(latest[1], latest[3] or latest[1]) if latest else None
+    response = not_modified(tuple(latest or ()), version, last_modified=modified)
+    if response is not None:
+        return response
+
+    cursor = request.args.get('cursor')
+    # pages within the newest RECENT_POSTS_SIZE posts come from memory, see app/recent.py
+    posts = recent.page(cursor, current_app.config['POSTS_PER_PAGE']) if recent else None
+    if posts is not None:
+        return stream_page('index.html', title=_l('Explore'), posts=posts.items,
+                           next_url=url_for('main.explore', cursor=posts.next_cursor)
+                           if posts.next_cursor else None,
+                           prev_url=url_for('main.explore', cursor=posts.prev_cursor)
+                           if posts.prev_cursor else None)
+    query = sa.select(Post).options(so.selectinload(Post.author))
+    posts = stream_posts(query, (Post.timestamp, Post.id), cursor)
+    return stream_page('index.html', title=_l('Explore'), posts=posts,
+                       next_url=PageURL(posts, 'next_cursor', 'main.explore'),
+                       prev_url=PageURL(posts, 'prev_cursor', 'main.explore'))
 
 @bp.route('/search')
 @login_required
+@read_only
 def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
-    page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page,
-                               current_app.config['POSTS_PER_PAGE'])
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
-        if total > page * current_app.config['POSTS_PER_PAGE'] else None
-    prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
-        if page > 1 else None
-    return render_template('search.html', title=_('Search'), posts=posts,
-                           next_url=next_url, prev_url=prev_url)
+    cursor = request.args.get('cursor')
+    posts, next_cursor, prev_cursor = Post.search(
+        g.search_form.q.data, current_app.config['POSTS_PER_PAGE'], cursor)
+    next_url = url_for('main.search', q=g.search_form.q.data, cursor=next_cursor) \
+        if next_cursor else None
+    prev_url = url_for('main.search', q=g.search_form.q.data, cursor=prev_cursor) \
+        if prev_cursor else None
+    return stream_page('search.html', title=_('Search'), posts=posts,
+                       next_url=next_url, prev_url=prev_url)
 
 # dynamic path
 @bp.route('/user/<username>')
 @login_required
+@read_only
 def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get(_l('page'), 1, type=int)
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for(_l('main.user'), username=user.username, page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for(_l('main.user'), username=user.username, page=posts.prev_num) \
-        if posts.has_prev else None
+    latest = db.session.execute(
+        sa.select(Post.id, content_version_column()).where(Post.user_id == user.id)
+        .order_by(Post.id.desc()).limit(1)).first()
+    response = not_modified(tuple(latest or ()), user.username, user.about_me, user.last_seen,
+                            user.avatar_hash, user.num_posts, user.num_followers,
+                            user.num_following, current_user.follow_version, csrf=True)
+    if response is not None:
+        return response
+
+    cursor = request.args.get('cursor')
+    # no eager load: every post.author is `user`, resolved from the identity map
+    posts = stream_posts(user.posts.select(), (Post.timestamp, Post.id), cursor)
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items, 
-                           next_url=next_url, prev_url=prev_url, form=form)
+    return stream_page('user.html', user=user, posts=posts, form=form,
+                       next_url=PageURL(posts, 'next_cursor', 'main.user',
+                                        username=user.username),
+                       prev_url=PageURL(posts, 'prev_cursor', 'main.user',
+                                        username=user.username))
 
 @bp.route('/follow/<username>', methods=['POST'])
 @login_required
@@ -163,3 +207,29 @@ def translate_text():
     return {'text': translate(data['text'],
                               data['source_language'],
                               data['dest_language'])}
+
+# translates a page of posts in one round trip: {"post_ids": [...], "dest_language": "en"}
+@bp.route('/translate/posts', methods=['POST'])
+@login_required
+def translate_posts():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('dest_language'), str) or \
+            not isinstance(data.get('post_ids'), list):
+        return bad_request('post_ids and dest_language are required.')
+    dest_language = data['dest_language']
+    try:
+        ids = [int(id) for id in data['post_ids']][:current_app.config['POSTS_PER_PAGE'] * 4]
+    except (TypeError, ValueError):
+        return bad_request('post_ids must be integers.')
+    # one upstream request per source language
+    groups = {}
+    for id, body, language in db.session.execute(
+            sa.select(Post.id, Post.body, Post.language).where(Post.id.in_(ids))):
+        if language and language != dest_language:
+            groups.setdefault(language, []).append((id, body))
+    translations = {}
+    for language, posts in groups.items():
+        texts = translate_many([body for id, body in posts], language, dest_language)
+        for (id, body), text in zip(posts, texts):
+            translations[str(id)] = text
+    return {'translations': translations}
@@ -0,0 +1,292 @@
+import json
+import os
+import tempfile
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+import sqlalchemy as sa
+from flask import Response, abort, current_app, g, has_app_context, has_request_context, \
+    request
+from flask.signals import before_render_template, template_rendered
+from app import db
+from app.streaming import after_body
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+# name -> (help, buckets, label or labels); with several labels the values are
+# kept joined by LABEL_SEPARATOR
+HISTOGRAMS = {
+    'microblog_request_duration_seconds': ('Wall time per request.', TIME_BUCKETS,
+                                           ('endpoint', 'outcome')),
+    'microblog_request_sql_statements': ('SQL statements per request.', COUNT_BUCKETS, 'endpoint'),
+    'microblog_request_sql_seconds': ('Time spent in SQL per request.', TIME_BUCKETS, 'endpoint'),
+    'microblog_request_template_seconds': ('Time spent rendering templates per request.',
+                                           TIME_BUCKETS, 'endpoint'),
+    'microblog_request_external_seconds': ('Time spent in Elasticsearch, translator and SMTP '
+                                           'calls per request.', TIME_BUCKETS, 'endpoint'),
+    'microblog_external_call_seconds': ('Duration of calls to external services.',
+                                        TIME_BUCKETS, ('service', 'outcome')),
+}
+LABEL_SEPARATOR = '\t'
+
+# name -> (help, type, label); single values, added up across workers
+VALUES = {
+    'microblog_circuit_open': ('Workers whose circuit breaker to the service is open or '
+                               'half-open.', 'gauge', 'service'),
+    'microblog_circuit_rejected_total': ('Calls failed fast by an open circuit breaker.',
+                                         'counter', 'service'),
+}
+
+# slow request logs keep at most this many statements
+MAX_LOGGED_STATEMENTS = 50
+
+
+class RequestMetrics:
+    def __init__(self, keep_statements):
+        self.start = perf_counter()
+        self.ended = False  # after_request has seen the response
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.template_start = 0.0
+        self.external_time = 0.0
+        self.statements = [] if keep_statements else None
+
+
+# histograms are kept per worker process; with METRICS_DIR set every worker also
+# writes a snapshot there and /metrics adds them all up
+class Metrics:
+    def __init__(self, app):
+        self.app = app
+        self._series = {}  # name -> {label value: [bucket counts..., +Inf, sum, count]}
+        self._lock = threading.Lock()
+        self.writer = None
+        if not app.config['METRICS_ENABLED']:
+            return
+
+        with app.app_context():
+            for engine in db.engines.values():
+                sa.event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+                sa.event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        app.teardown_request(self._abort_request)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+        if app.config['METRICS_DIR']:
+            from app.background import PeriodicWorker
+            os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+            self.writer = PeriodicWorker(app, self.write_snapshot,
+                                         app.config['METRICS_WRITE_INTERVAL'], 'metrics')
+            app.before_request(self.writer.start)
+
+    def observe(self, name, label, value):
+        buckets = HISTOGRAMS[name][1]
+        if isinstance(label, tuple):
+            label = LABEL_SEPARATOR.join(label)
+        with self._lock:
+            row = self._series.setdefault(name, {}).get(label)
+            if row is None:
+                row = self._series[name][label] = [0] * (len(buckets) + 1) + [0.0, 0]
+            row[bisect_left(buckets, value)] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def set_value(self, name, label, value, add=False):
+        with self._lock:
+            row = self._series.setdefault(name, {}).setdefault(label, [0])
+            row[0] = row[0] + value if add else value
+
+    def snapshot(self):
+        with self._lock:
+            return {name: {label: list(row) for label, row in series.items()}
+                    for name, series in self._series.items()}
+
+    # --- request instrumentation ---
+
+    def _start_request(self):
+        g.request_metrics = RequestMetrics(bool(self.app.config['METRICS_SLOW_REQUEST']))
+
+    # a streamed page is measured until its body has been sent
+    def _end_request(self, response):
+        m = g.get('request_metrics')
+        if m is None:
+            return response
+        m.ended = True
+        state = g._get_current_object()
+        endpoint = request.endpoint or 'unmatched'
+        description = f'{request.method} {request.full_path} ({endpoint})'
+        outcome = 'error' if response.status_code >= 500 else 'ok'
+
+        def end():
+            state.pop('request_metrics', None)
+            self._observe_request(m, endpoint, description, outcome)
+        return after_body(response, end)
+
+    # teardown: the request failed before after_request saw a response
+    def _abort_request(self, error):
+        m = g.get('request_metrics')
+        if m is not None and not m.ended:
+            g.pop('request_metrics')
+            endpoint = request.endpoint or 'unmatched'
+            self._observe_request(m, endpoint,
+                                  f'{request.method} {request.full_path} ({endpoint})', 'error')
+
+    def _observe_request(self, m, endpoint, description, outcome):
+        elapsed = perf_counter() - m.start
+        self.observe('microblog_request_duration_seconds', (endpoint, outcome), elapsed)
+        self.observe('microblog_request_sql_statements', endpoint, m.sql_count)
+        self.observe('microblog_request_sql_seconds', endpoint, m.sql_time)
+        self.observe('microblog_request_template_seconds', endpoint, m.template_time)
+        self.observe('microblog_request_external_seconds', endpoint, m.external_time)
+
+        slow = self.app.config['METRICS_SLOW_REQUEST']
+        if slow and elapsed >= slow:
+            self.app.logger.warning(
+                'Slow request %s: %.3fs, %d SQL statements in %.3fs, '
+                'templates %.3fs, external calls %.3fs\n%s',
+                description, elapsed, m.sql_count, m.sql_time,
+                m.template_time, m.external_time, '\n'.join(m.statements))
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'request_metrics' in g:
+            conn.info.setdefault('metrics_query_start', []).append(perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('metrics_query_start')
+        if not starts or not has_request_context() or 'request_metrics' not in g:
+            return
+        m = g.request_metrics
+        m.sql_count += 1
+        m.sql_time += perf_counter() - starts.pop()
+        if m.statements is not None and len(m.statements) < MAX_LOGGED_STATEMENTS:
+            m.statements.append(statement)
+
+    # render_post() renders inside the page template, only the outermost render counts
+    def _before_render(self, sender, template, context, **extra):
+        m = g.get('request_metrics') if has_request_context() else None
+        if m is not None:
+            if m.template_depth == 0:
+                m.template_start = perf_counter()
+            m.template_depth += 1
+
+    def _after_render(self, sender, template, context, **extra):
+        m = g.get('request_metrics') if has_request_context() else None
+        if m is not None and m.template_depth:
+            m.template_depth -= 1
+            if m.template_depth == 0:
+                m.template_time += perf_counter() - m.template_start
+
+    # --- exposition ---
+
+    def _snapshot_path(self, pid=None):
+        return os.path.join(self.app.config['METRICS_DIR'], f'{pid or os.getpid()}.json')
+
+    def write_snapshot(self):
+        directory = self.app.config['METRICS_DIR']
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, self._snapshot_path())
+
+    def collect(self):
+        snapshots = [self.snapshot()]
+        directory = self.app.config['METRICS_DIR']
+        if directory:
+            own = os.path.basename(self._snapshot_path())
+            for name in os.listdir(directory):
+                if not name.endswith('.json') or name == own:
+                    continue
+                # a worker that is gone would report its last values forever
+                if not _running(name[:-len('.json')]):
+                    try:
+                        os.remove(os.path.join(directory, name))
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    with open(os.path.join(directory, name)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return merge(snapshots)
+
+    def view(self):
+        token = self.app.config['METRICS_TOKEN']
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            abort(403)
+        return Response(render(self.collect()), mimetype='text/plain; version=0.0.4')
+
+
+def _running(pid):
+    try:
+        os.kill(int(pid), 0)
+    except ValueError:
+        return True  # not a worker's snapshot, leave it alone
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # there is a process, someone else's
+    return True
+
+
+def merge(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for name, series in snapshot.items():
+            for label, row in series.items():
+                total = merged.setdefault(name, {}).get(label)
+                if total is None or len(total) != len(row):
+                    merged[name][label] = list(row)
+                else:
+                    merged[name][label] = [a + b for a, b in zip(total, row)]
+    return merged
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Prometheus text exposition format
+def render(snapshot):
+    lines = []
+    for name, (help, buckets, label_name) in HISTOGRAMS.items():
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} histogram')
+        names = label_name if isinstance(label_name, tuple) else (label_name,)
+        for label, row in sorted(snapshot.get(name, {}).items()):
+            label = ','.join(f'{n}="{_escape(v)}"'
+                             for n, v in zip(names, label.split(LABEL_SEPARATOR)))
+            cumulative = 0
+            for le, count in zip(buckets + ('+Inf',), row):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label},le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{label}}} {row[-2]}')
+            lines.append(f'{name}_count{{{label}}} {row[-1]}')
+    for name, (help, kind, label_name) in VALUES.items():
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        for label, row in sorted(snapshot.get(name, {}).items()):
+            lines.append(f'{name}{{{label_name}="{_escape(label)}"}} {row[0]}')
+    return '\n'.join(lines) + '\n'
+
+
+# times a call to Elasticsearch, the translator or the SMTP server, failed
+# calls included
+@contextmanager
+def external_call(service):
+    start = perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        elapsed = perf_counter() - start
+        metrics = getattr(current_app, 'metrics', None) if has_app_context() else None
+        if metrics is not None and current_app.config['METRICS_ENABLED']:
+            metrics.observe('microblog_external_call_seconds', (service, outcome), elapsed)
+        if has_request_context() and 'request_metrics' in g:
+            g.request_metrics.external_time += elapsed
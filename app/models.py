@@ -1,5 +1,5 @@
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from typing import Optional
 import sqlalchemy as sa  # “sa” = SQLAlchemy Core helpers (select, func, etc.)
 import sqlalchemy.orm as so  # “so” = ORM helpers (Mapped, mapped_column, relationship)
@@ -7,10 +7,12 @@ from flask import current_app
 from app import db, login
 from flask_login import UserMixin
 from hashlib import md5
+import secrets
 from time import time
 import jwt
 from flask_babel import _, lazy_gettext as _l
-from app.search import add_to_index, remove_from_index, query_index
+from app.search import add_to_index, remove_from_index, query_index, bulk_reindex, \
+    register_local_index
 
 
 followers = sa.Table(
@@ -20,16 +22,66 @@ followers = sa.Table(
     sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True)
 )
 
+# materialized home timeline: one row per (reader, post), filled on write
+timeline = sa.Table(
+    'timeline',
+    db.metadata,
+    sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+    sa.Column('post_id', sa.Integer, sa.ForeignKey('post.id', ondelete='CASCADE'), primary_key=True),
+    sa.Column('timestamp', sa.DateTime, nullable=False),
+    # matches the feed's (timestamp, post_id) keyset order, no sort step
+    sa.Index('ix_timeline_user_id_timestamp_post_id', 'user_id', 'timestamp', 'post_id')
+)
+
+# a single row, bumped when something every page of posts may show changes
+# without a new post: author names and avatars, detected languages. Part of the
+# page ETags, and changed_at of Last-Modified, see app/conditional.py
+content_version = sa.Table(
+    'content_version',
+    db.metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('version', sa.Integer, nullable=False, server_default='0'),
+    sa.Column('changed_at', sa.DateTime, nullable=True)
+)
+sa.event.listen(content_version, 'after_create', sa.DDL(
+    'INSERT INTO content_version (id, version) VALUES (1, 0)'))
+
+def bump_content_version(conn):
+    conn.execute(sa.update(content_version).values(version=content_version.c.version + 1,
+                                                   changed_at=datetime.now(timezone.utc)))
+
+# for the validator queries: one more column rather than one more statement
+def content_version_column():
+    return sa.select(content_version.c.version).scalar_subquery()
+
+def content_changed_column():
+    return sa.select(content_version.c.changed_at).scalar_subquery()
+
 class User(UserMixin, db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     username: so.Mapped[str] = so.mapped_column(sa.String(64), index=True, unique=True)
     email: so.Mapped[str] = so.mapped_column(sa.String(120), index=True, unique=True)
+    # gravatar digest of the email, kept in step by _set_avatar_hash()
+    avatar_hash: so.Mapped[str] = so.mapped_column(sa.String(32))
     password_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
 
     posts: so.WriteOnlyMapped['Post'] = so.relationship(back_populates='author')
 
     about_me: so.Mapped[Optional[str]] = so.mapped_column(sa.String(140))
     last_seen: so.Mapped[Optional[datetime]] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+    # set once the author outgrows TIMELINE_FANOUT_LIMIT, their posts are then read at query time
+    timeline_pull: so.Mapped[bool] = so.mapped_column(default=False, server_default=sa.false())
+
+    # denormalized counters, kept in step by follow()/unfollow() and Post.update_counters
+    num_followers: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    num_following: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    num_posts: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    # bumped on every follow/unfollow, part of the home and profile page ETags
+    follow_version: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+
+    # bearer token for the /api blueprint
+    token: so.Mapped[Optional[str]] = so.mapped_column(sa.String(32), index=True, unique=True)
+    token_expiration: so.Mapped[Optional[datetime]]
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -37,9 +89,13 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    @so.validates('email')
+    def _set_avatar_hash(self, key, email):
+        self.avatar_hash = md5(email.lower().encode('utf-8')).hexdigest()
+        return email
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return f'https://www.gravatar.com/avatar/{self.avatar_hash}?d=identicon&s={size}'
 
     following: so.WriteOnlyMapped['User'] = so.relationship(
         secondary=followers, primaryjoin=(followers.c.follower_id == id),
@@ -54,40 +110,98 @@ class User(UserMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            # increment in SQL so concurrent follows don't lose updates
+            self.num_following = User.num_following + 1
+            user.num_followers = User.num_followers + 1
+            self.follow_version = User.follow_version + 1
+            if not user.timeline_pull:
+                # copy the author's history so it shows up on the next home page
+                db.session.execute(timeline.insert().from_select(
+                    ['user_id', 'post_id', 'timestamp'],
+                    sa.select(sa.literal(self.id), Post.id, Post.timestamp)
+                    .where(Post.user_id == user.id)))
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self.num_following = User.num_following - 1
+            user.num_followers = User.num_followers - 1
+            self.follow_version = User.follow_version + 1
+            db.session.execute(timeline.delete().where(
+                timeline.c.user_id == self.id,
+                timeline.c.post_id.in_(sa.select(Post.id).where(Post.user_id == user.id))))
 
-    # if a given user is already include
+    # if a given user is already include; only needs self.id, see SessionUser
     def is_following(self, user):
-        query = self.following.select().where(User.id == user.id)
+        query = sa.select(followers.c.followed_id).where(
+            followers.c.follower_id == self.id, followers.c.followed_id == user.id)
         return db.session.scalar(query) is not None
 
     def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery())
-        return db.session.scalar(query)
+        return self.num_followers
 
     def following_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.following.select().subquery())
-        return db.session.scalar(query)
+        return self.num_following
+
+    def posts_count(self):
+        return self.num_posts
+
+    # recompute all counters from the source tables, returns the number of users fixed
+    @staticmethod
+    def repair_counters():
+        num_followers = sa.select(sa.func.count()).select_from(followers).where(
+            followers.c.followed_id == User.id).scalar_subquery()
+        num_following = sa.select(sa.func.count()).select_from(followers).where(
+            followers.c.follower_id == User.id).scalar_subquery()
+        num_posts = sa.select(sa.func.count(Post.id)).where(
+            Post.user_id == User.id).scalar_subquery()
+        query = (
+            sa.update(User)
+            .where(sa.or_(User.num_followers != num_followers,
+                          User.num_following != num_following,
+                          User.num_posts != num_posts))
+            .values(num_followers=num_followers, num_following=num_following,
+                    num_posts=num_posts)
+            .execution_options(synchronize_session=False)
+        )
+        result = db.session.execute(query)
+        db.session.commit()
+        return result.rowcount
+
+    # high-follower authors are not pushed, their posts are merged in at read time
+    def pulled_authors(self):
+        return sa.select(User.id) \
+            .join(followers, followers.c.followed_id == User.id) \
+            .where(followers.c.follower_id == self.id, User.timeline_pull)
+
+    # (post_id, timestamp) rows of the home timeline
+    def timeline_feed(self):
+        feed = sa.select(timeline.c.post_id, timeline.c.timestamp).where(
+            timeline.c.user_id == self.id)
+        pulled = db.session.scalars(self.pulled_authors()).all()
+        if pulled:
+            feed = sa.union(feed, sa.select(Post.id, Post.timestamp).where(
+                Post.user_id.in_(pulled)))
+        return feed.subquery('feed')
+
+    # the newest row of timeline_feed() in one statement: each side of the union
+    # is cut to its top row on its own index before the outer ORDER BY/LIMIT
+    def timeline_latest(self):
+        pushed = sa.select(timeline.c.post_id, timeline.c.timestamp) \
+            .where(timeline.c.user_id == self.id) \
+            .order_by(timeline.c.timestamp.desc(), timeline.c.post_id.desc()).limit(1)
+        pulled = sa.select(Post.id.label('post_id'), Post.timestamp) \
+            .where(Post.user_id.in_(self.pulled_authors().scalar_subquery())) \
+            .order_by(Post.timestamp.desc(), Post.id.desc()).limit(1)
+        return sa.union_all(sa.select(pushed.subquery()),
+                            sa.select(pulled.subquery())).subquery('feed')
 
     def following_posts(self):
-        # gives each row its own name
-        Author = so.aliased(User)
-        Follower = so.aliased(User)
+        feed = self.timeline_feed()
         return (
             sa.select(Post)
-            .join(Post.author.of_type(Author))
-            .join(Author.followers.of_type(Follower), isouter=True) # Shows posts in either condition
-            .where(sa.or_(
-                Follower.id == self.id, # I follow the Author 
-                Author.id == self.id, # I am the Author
-            ))
-            .group_by(Post)
-            .order_by(Post.timestamp.desc()) #sorting
+            .join(feed, feed.c.post_id == Post.id)
+            .order_by(feed.c.timestamp.desc(), feed.c.post_id.desc()) #sorting
         )
     
     def get_reset_password_token(self, expires_in=600): # token valid for 10 mins
@@ -106,55 +220,122 @@ class User(UserMixin, db.Model):
             return # any thing goes wrong, returns to None
         return db.session.get(User, id)
 
+    def get_token(self, expires_in=3600):
+        now = datetime.now(timezone.utc)
+        # reuse a token that still has at least a minute left
+        if self.token and self.token_expiration.replace(
+                tzinfo=timezone.utc) > now + timedelta(seconds=60):
+            return self.token
+        self.token = secrets.token_hex(16)
+        self.token_expiration = now + timedelta(seconds=expires_in)
+        db.session.add(self)
+        return self.token
+
+    def revoke_token(self):
+        self.token_expiration = datetime.now(timezone.utc) - timedelta(seconds=1)
+
+    @staticmethod
+    def check_token(token):
+        user = db.session.scalar(sa.select(User).where(User.token == token))
+        if user is None or user.token_expiration.replace(
+                tzinfo=timezone.utc) < datetime.now(timezone.utc):
+            return None
+        return user
+
     def __repr__(self):
         return '<User {}>'.format(self.username)  
 
+    # cached session users of changed rows are dropped on commit, see app/session_user.py
+    @classmethod
+    def track_changes(cls, session, flush_context):
+        ids = [obj.id for obj in session.dirty | session.deleted if isinstance(obj, cls)]
+        if ids:
+            session.info.setdefault('changed_users', set()).update(ids)
+        # names and avatars are shown next to every post
+        if any(isinstance(obj, cls) and (
+                sa.inspect(obj).attrs.username.history.has_changes() or
+                sa.inspect(obj).attrs.avatar_hash.history.has_changes())
+               for obj in session.dirty):
+            bump_content_version(session.connection())
+
+    @classmethod
+    def publish_changes(cls, session):
+        ids = session.info.pop('changed_users', None)
+        if ids:
+            current_app.session_users.invalidate(ids)
+
+    @classmethod
+    def discard_changes(cls, session, previous_transaction=None):
+        session.info.pop('changed_users', None)
+
+db.event.listen(db.session, 'after_flush', User.track_changes)
+db.event.listen(db.session, 'after_commit', User.publish_changes)
+db.event.listen(db.session, 'after_soft_rollback', User.discard_changes)
+
 class SearchableMixin(object):
     @classmethod
-    def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+    def search(cls, expression, per_page, cursor=None):
+        ids, next_cursor, prev_cursor = query_index(
+            cls.__tablename__, expression, per_page, cursor)
         # fast exist
-        if total == 0:
-            return [], 0
-        when = []
-        # rank the DB result in same order as ES
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        query = sa.select(cls).where(cls.id.in_(ids)).order_by(
-            db.case(*when, value=cls.id))
-        return db.session.scalars(query), total
-
-    # event handler, snapshots the changes
-    @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
-
-    # save changes to mirror the same operations to ES
+        if not ids:
+            return [], next_cursor, prev_cursor
+        # batch-load relationships (e.g. Post.author) instead of one query per row
+        query = sa.select(cls).where(cls.id.in_(ids)).options(so.selectinload('*'))
+        return cls._fetch(query, ids), next_cursor, prev_cursor
+
+    # runs on first iteration, so a streamed page loads the rows while rendering;
+    # one IN query, put back in the order of the index
+    @staticmethod
+    def _fetch(query, ids):
+        rank = {id: i for i, id in enumerate(ids)}
+        yield from sorted(db.session.scalars(query), key=lambda obj: rank[obj.id])
+
+    # event handler, queues the changes in the same transaction as the data;
+    # after_flush (not before_commit) so new rows already have their ids
     @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
+    def after_flush(cls, session, flush_context):
+        changes = []
+        for obj in session.new:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+                changes.append((obj, 'index'))
+        for obj in session.dirty:
+            if isinstance(obj, SearchableMixin) and any(
+                    sa.inspect(obj).attrs[field].history.has_changes()
+                    for field in obj.__searchable__):
+                changes.append((obj, 'index'))
+        for obj in session.deleted:
             if isinstance(obj, SearchableMixin):
+                changes.append((obj, 'delete'))
+        if not changes:
+            return
+
+        # the local index is updated right away, it lives in the same database
+        for obj, op in changes:
+            if op == 'index':
                 add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
+            else:
                 remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        # queued even while the circuit breaker is open, sent once the cluster is back
+        if current_app.elasticsearch is not None:
+            session.connection().execute(sa.insert(SearchOutbox.__table__), [
+                {'index_name': obj.__tablename__, 'object_id': obj.id, 'op': op}
+                for obj, op in changes])
+            session.info['search_outbox'] = True
 
-    # rebuild the ES index from changed database
+    # hand the queued changes to the background indexer, see app.search.drain_outbox
     @classmethod
-    def reindex(cls):
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__, obj)
+    def after_commit(cls, session):
+        if session.info.pop('search_outbox', False):
+            current_app.search_indexer.wake()
 
-# before/after every commit, the mixin syncs ES automatically.
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+    # rebuild the ES index from changed database, see `flask search reindex`
+    @classmethod
+    def reindex(cls, **kwargs):
+        return bulk_reindex(cls, **kwargs)
+
+# on every flush/commit, the mixin syncs ES automatically.
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
 
 class Post(SearchableMixin, db.Model):
@@ -165,12 +346,158 @@ class Post(SearchableMixin, db.Model):
 
     author: so.Mapped[User] = so.relationship(back_populates='posts')
     language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5), index=True)
+    # bumped by every ORM update (bump_version), part of the rendered fragment's cache stamp
+    version: so.Mapped[int] = so.mapped_column(default=1, server_default='1')
     __searchable__ = ['body'] # lists the field that need to be include in index
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)   
 
+    # incremented in SQL: concurrent updates both count, and neither fails
+    # the way a version_id_col check would
+    @classmethod
+    def bump_version(cls, mapper, connection, target):
+        target.version = cls.version + 1
+
+    # push new posts into the followers' timelines, in the same transaction
+    @classmethod
+    def fan_out(cls, session, flush_context):
+        conn = session.connection()
+        limit = current_app.config.get('TIMELINE_FANOUT_LIMIT')
+        for obj in session.new:
+            if not isinstance(obj, cls):
+                continue
+            pull, count = conn.execute(sa.select(User.timeline_pull, User.num_followers)
+                                       .where(User.id == obj.user_id)).one()
+            if not pull and limit is not None and count > limit:
+                conn.execute(sa.update(User).where(User.id == obj.user_id).values(
+                    timeline_pull=True))
+                pull = True
+            # the author always sees their own post
+            rows = sa.select(cls.user_id, cls.id, cls.timestamp).where(cls.id == obj.id)
+            if not pull:
+                rows = sa.union(rows, sa.select(followers.c.follower_id, cls.id, cls.timestamp)
+                                .join(cls, cls.user_id == followers.c.followed_id)
+                                .where(cls.id == obj.id))
+            conn.execute(timeline.insert().from_select(['user_id', 'post_id', 'timestamp'], rows))
+        deleted = [obj.id for obj in session.deleted if isinstance(obj, cls)]
+        if deleted:
+            conn.execute(timeline.delete().where(timeline.c.post_id.in_(deleted)))
+
+    # keep User.num_posts in step with inserted and deleted posts
+    @classmethod
+    def update_counters(cls, session, flush_context):
+        conn = session.connection()
+        for objs, step in ((session.new, 1), (session.deleted, -1)):
+            for obj in objs:
+                if isinstance(obj, cls):
+                    conn.execute(sa.update(User).where(User.id == obj.user_id).values(
+                        num_posts=User.num_posts + step))
+
+    # rebuild the materialized timeline from posts and follows, after bulk loads;
+    # expects correct counters, see User.repair_counters()
+    @classmethod
+    def rebuild_timeline(cls):
+        limit = current_app.config.get('TIMELINE_FANOUT_LIMIT')
+        if limit is not None:
+            db.session.execute(sa.update(User).where(User.num_followers > limit)
+                               .values(timeline_pull=True)
+                               .execution_options(synchronize_session=False))
+        db.session.execute(timeline.delete())
+        rows = sa.union(
+            sa.select(cls.user_id, cls.id, cls.timestamp),
+            sa.select(followers.c.follower_id, cls.id, cls.timestamp)
+            .join(cls, cls.user_id == followers.c.followed_id)
+            .join(User, User.id == cls.user_id)
+            .where(User.timeline_pull == sa.false()))
+        result = db.session.execute(
+            timeline.insert().from_select(['user_id', 'post_id', 'timestamp'], rows))
+        db.session.commit()
+        return result.rowcount
+
+    # drop cached fragments of edited and deleted posts, see app/fragments.py
+    @classmethod
+    def drop_fragments(cls, session, flush_context):
+        ids = [obj.id for obj in session.dirty | session.deleted if isinstance(obj, cls)]
+        if ids:
+            current_app.post_fragments.forget(ids)
+
+    # changes for the explore buffer of this process, handed over on commit;
+    # see app/recent.py
+    @classmethod
+    def track_recent(cls, session, flush_context):
+        from app.recent import changes_from_flush  # local import to avoid circulars
+        changes = changes_from_flush(session)
+        if changes:
+            session.info.setdefault('recent_posts', []).extend(changes)
+
+    @classmethod
+    def publish_recent(cls, session):
+        changes = session.info.pop('recent_posts', None)
+        if changes:
+            current_app.recent_posts.apply(changes)
+
+    @classmethod
+    def discard_recent(cls, session, previous_transaction=None):
+        session.info.pop('recent_posts', None)
+
+register_local_index(Post)
+
+db.event.listen(Post, 'before_update', Post.bump_version)
+db.event.listen(db.session, 'after_flush', Post.fan_out)
+db.event.listen(db.session, 'after_flush', Post.update_counters)
+db.event.listen(db.session, 'after_flush', Post.drop_fragments)
+db.event.listen(db.session, 'after_flush', Post.track_recent)
+db.event.listen(db.session, 'after_commit', Post.publish_recent)
+db.event.listen(db.session, 'after_soft_rollback', Post.discard_recent)
+
+# durable work queue rows, claimed and retried by app.outbox
+class OutboxMixin(object):
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    created: so.Mapped[datetime] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+    attempts: so.Mapped[int] = so.mapped_column(default=0)
+    next_attempt: so.Mapped[datetime] = so.mapped_column(
+        index=True, default=lambda: datetime.now(timezone.utc))
+    locked_until: so.Mapped[Optional[datetime]]
+    lock_token: so.Mapped[Optional[str]] = so.mapped_column(sa.String(32), index=True)
+    last_error: so.Mapped[Optional[str]] = so.mapped_column(sa.String(512))
+    # set when the row is given up on, see app.outbox.dead_letter
+    failed_at: so.Mapped[Optional[datetime]]
+
+# index changes waiting to be sent to Elasticsearch
+class SearchOutbox(OutboxMixin, db.Model):
+    __tablename__ = 'search_outbox'
+    index_name: so.Mapped[str] = so.mapped_column(sa.String(64))
+    object_id: so.Mapped[int]
+    op: so.Mapped[str] = so.mapped_column(sa.String(6)) # 'index' or 'delete'
+
+    def __repr__(self):
+        return '<SearchOutbox {} {}/{}>'.format(self.op, self.index_name, self.object_id)
+
+# messages waiting to be sent by app.email.drain_outbox()
+class EmailOutbox(OutboxMixin, db.Model):
+    __tablename__ = 'email_outbox'
+    sender: so.Mapped[str] = so.mapped_column(sa.String(120))
+    recipients: so.Mapped[list[str]] = so.mapped_column(sa.JSON)
+    subject: so.Mapped[str] = so.mapped_column(sa.String(255))
+    text_body: so.Mapped[str] = so.mapped_column(sa.Text)
+    html_body: so.Mapped[Optional[str]] = so.mapped_column(sa.Text)
+
+    def __repr__(self):
+        return '<EmailOutbox {} {}>'.format(self.id, self.subject)
+
+# cached machine translations, keyed by app.translate.translation_key()
+class Translation(db.Model):
+    key: so.Mapped[str] = so.mapped_column(sa.String(64), primary_key=True)
+    source_language: so.Mapped[str] = so.mapped_column(sa.String(16))
+    dest_language: so.Mapped[str] = so.mapped_column(sa.String(16))
+    text: so.Mapped[str] = so.mapped_column(sa.Text)
+    created: so.Mapped[datetime] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return '<Translation {}>'.format(self.key)
+
 @login.user_loader
 def load_user(id):
-    return db.session.get(User, int(id))
+    return current_app.session_users.load(int(id))
 
@@ -0,0 +1,53 @@
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+import sqlalchemy as sa
+from app import db
+
+# exponential backoff with jitter, capped at `cap` seconds
+def retry_delay(attempts, base=2, cap=3600):
+    delay = min(cap, base ** attempts)
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+# lock up to `limit` due rows for `lease` seconds and return them; rows whose
+# lease runs out (e.g. the worker died) become claimable again
+def claim(model, limit, lease=300):
+    now = datetime.now(timezone.utc)
+    token = uuid.uuid4().hex
+    available = sa.or_(model.locked_until.is_(None), model.locked_until < now)
+    ids = db.session.scalars(
+        sa.select(model.id).where(model.next_attempt <= now, model.failed_at.is_(None), available)
+        .order_by(model.id).limit(limit)).all()
+    if not ids:
+        return []
+    # the lock condition is repeated so concurrent workers can't claim a row twice
+    db.session.execute(
+        sa.update(model).where(model.id.in_(ids), available)
+        .values(locked_until=now + timedelta(seconds=lease), lock_token=token)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+    return db.session.scalars(
+        sa.select(model).where(model.lock_token == token).order_by(model.id)).all()
+
+def done(rows):
+    for row in rows:
+        db.session.delete(row)
+
+def retry_later(rows, error):
+    now = datetime.now(timezone.utc)
+    for row in rows:
+        row.attempts += 1
+        row.next_attempt = now + retry_delay(row.attempts)
+        row.locked_until = None
+        row.lock_token = None
+        row.last_error = str(error)[:512]
+
+# rows that can never succeed stay in the table for inspection but are not claimed again
+def dead_letter(rows, error):
+    now = datetime.now(timezone.utc)
+    for row in rows:
+        row.attempts += 1
+        row.failed_at = now
+        row.locked_until = None
+        row.lock_token = None
+        row.last_error = str(error)[:512]
@@ -0,0 +1,192 @@
+import base64
+import json
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+import sqlalchemy as sa
+from flask import url_for
+from app import db
+
+# opaque, url-safe page tokens: base64 of a small JSON object
+def encode_cursor(data):
+    raw = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+# returns None for missing or tampered tokens, which means "first page"
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor # older items
+        self.prev_cursor = prev_cursor # newer items
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def _key_cursor(row, direction):
+    return encode_cursor({'t': row[-2].isoformat(), 'i': row[-1], 'd': direction})
+
+# (timestamp, id) of a page token and whether it points back to newer items;
+# None for the first page
+def _decode_key(cursor):
+    data = decode_cursor(cursor)
+    try:
+        return (datetime.fromisoformat(data['t']), int(data['i'])), data.get('d') == 'prev'
+    except (TypeError, KeyError, ValueError):
+        return None, False
+
+def _keyset_select(query, key, cursor, per_page):
+    ts_col, id_col = key
+    stmt = query.add_columns(ts_col, id_col).order_by(None).limit(per_page + 1)
+
+    position, backwards = _decode_key(cursor)
+    if position is None:
+        return stmt.order_by(ts_col.desc(), id_col.desc()), True, False
+    ts, id = position
+    if backwards:
+        stmt = stmt.where(sa.or_(ts_col > ts, sa.and_(ts_col == ts, id_col > id))) \
+            .order_by(ts_col.asc(), id_col.asc())
+    else:
+        stmt = stmt.where(sa.or_(ts_col < ts, sa.and_(ts_col == ts, id_col < id))) \
+            .order_by(ts_col.desc(), id_col.desc())
+    return stmt, False, backwards
+
+# first and last are the rows at the top and bottom of the page as shown
+def _cursors(first, last, more, first_page, backwards):
+    # coming back from an older page means there is always an older page
+    has_next = more or backwards
+    has_prev = more if backwards else not first_page
+    next_cursor = prev_cursor = None
+    if last is not None and has_next:
+        next_cursor = _key_cursor(last, 'next')
+    if first is not None and has_prev:
+        prev_cursor = _key_cursor(first, 'prev')
+    return next_cursor, prev_cursor
+
+# newest-first pagination on (timestamp, id), page N costs the same as page 1.
+# Items are the first entity of each row, or with rows=True the whole row
+# (a tuple, for Core column projections)
+def keyset_paginate(query, key, cursor, per_page, rows=False):
+    stmt, first_page, backwards = _keyset_select(query, key, cursor, per_page)
+    result = db.session.execute(stmt).all()
+    more = len(result) > per_page
+    result = result[:per_page]
+    if backwards:
+        result.reverse()
+
+    next_cursor, prev_cursor = _cursors(result[0] if result else None,
+                                        result[-1] if result else None,
+                                        more, first_page, backwards)
+    items = [tuple(row[:-2]) for row in result] if rows else [row[0] for row in result]
+    return KeysetPage(items, next_cursor, prev_cursor)
+
+
+# keyset_paginate() for stream_template(): the query runs while the page is
+# iterated, `batch` rows at a time (yield_per), so rendering starts with the
+# first rows and only one batch of posts is held at once. It can be iterated
+# once and the cursors are known at the end; reading them earlier drains it
+class KeysetStream:
+    def __init__(self, query, key, cursor, per_page, batch):
+        self._stmt, self._first_page, self._backwards = _keyset_select(
+            query, key, cursor, per_page)
+        self._per_page = per_page
+        self._batch = batch
+        self._started = self._done = False
+        self._next_cursor = self._prev_cursor = None
+
+    def __iter__(self):
+        if self._started:
+            return
+        self._started = True
+        # Result.yield_per() rather than the yield_per execution option, which the
+        # ORM passes on to selectinload() queries when a do_orm_execute hook is set
+        result = db.session.execute(self._stmt.execution_options(stream_results=True)) \
+            .yield_per(self._batch)
+        first = last = None
+        more = False
+        try:
+            if self._backwards:
+                # fetched in ascending order, the page has to be turned around
+                rows = result.all()
+                more = len(rows) > self._per_page
+                rows = rows[:self._per_page][::-1]
+            else:
+                rows = result
+            for count, row in enumerate(rows):
+                if count == self._per_page:
+                    more = True
+                    break
+                if first is None:
+                    first = row
+                last = row
+                yield row[0]
+        finally:
+            result.close()
+        self._next_cursor, self._prev_cursor = _cursors(
+            first, last, more, self._first_page, self._backwards)
+        self._done = True
+
+    def _drain(self):
+        if not self._done:
+            for _ in self:
+                pass
+
+    @property
+    def next_cursor(self):
+        self._drain()
+        return self._next_cursor
+
+    @property
+    def prev_cursor(self):
+        self._drain()
+        return self._prev_cursor
+
+
+# keyset_paginate() over rows held in memory: `rows` are (item, timestamp, id)
+# oldest first and `keys` their (timestamp, id). Returns None when the page
+# reaches past the oldest row and there may be older ones (complete=False)
+def keyset_window(rows, keys, cursor, per_page, complete=False):
+    position, backwards = _decode_key(cursor)
+    if backwards:
+        start = bisect_right(keys, position)
+        if start == 0 and not complete:
+            return None
+        page = rows[start:start + per_page + 1]
+        more = len(page) > per_page
+        page = page[:per_page]
+    else:
+        end = len(keys) if position is None else bisect_left(keys, position)
+        if end <= per_page and not complete:
+            return None
+        more = end > per_page
+        page = rows[max(end - per_page, 0):end]
+    page = page[::-1]
+    next_cursor, prev_cursor = _cursors(page[0] if page else None, page[-1] if page else None,
+                                        more, position is None, backwards)
+    return KeysetPage([row[0] for row in page], next_cursor, prev_cursor)
+
+
+# url_for() the page before or after a KeysetStream, resolved when the
+# template gets to the navigation links below the posts
+class PageURL:
+    def __init__(self, page, attr, endpoint, **values):
+        self.page = page
+        self.attr = attr
+        self.endpoint = endpoint
+        self.values = values
+
+    def __bool__(self):
+        return getattr(self.page, self.attr) is not None
+
+    def __str__(self):
+        cursor = getattr(self.page, self.attr)
+        return url_for(self.endpoint, cursor=cursor, **self.values) if cursor else ''
@@ -0,0 +1,60 @@
+import sqlalchemy as sa
+from flask import g, request, has_request_context
+from app import db
+from app.streaming import after_body
+
+
+class TooManyQueries(Exception):
+    pass
+
+
+# counts the SQL statements the engine sends while the block runs
+class QueryCounter:
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        if self.engine is None:
+            self.engine = db.engine
+        sa.event.listen(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc):
+        sa.event.remove(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries.append(statement)
+
+# debug/test guard: fail any request that issues more than SQL_QUERY_LIMIT statements
+def init_app(app):
+    if not app.config.get('SQL_QUERY_LIMIT'):
+        return
+    with app.app_context():
+        # the primary and any read replicas
+        for engine in db.engines.values():
+            sa.event.listen(engine, 'before_cursor_execute', _count_query)
+
+    @app.before_request
+    def start_query_count():
+        g.sql_queries = []
+
+    @app.after_request
+    def check_query_count(response):
+        # a streamed page keeps counting until its body has been sent
+        state, path = g._get_current_object(), request.path
+
+        def check():
+            queries = state.pop('sql_queries', [])
+            limit = app.config['SQL_QUERY_LIMIT']
+            if limit and len(queries) > limit:
+                raise TooManyQueries('{} issued {} SQL statements (limit {}):\n{}'.format(
+                    path, len(queries), limit, '\n'.join(queries)))
+        return after_body(response, check)
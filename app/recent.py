@@ -0,0 +1,227 @@
+import fcntl
+import os
+import threading
+from bisect import bisect_left
+from datetime import datetime, timezone
+import sqlalchemy as sa
+from app import db
+from app.models import User, Post
+from app.pagination import keyset_window
+
+# The newest RECENT_POSTS_SIZE posts, kept in every worker with their authors
+# so the first explore pages are served without SQL. Commits in this process
+# update the buffer directly; every change also bumps a sequence number in a
+# file under instance_path, and a worker that finds a number it did not write
+# reloads the buffer with one query.
+
+
+class RecentAuthor:
+    __slots__ = ('id', 'username', 'avatar_hash')
+
+    def __init__(self, id, username, avatar_hash):
+        self.id = id
+        self.username = username
+        self.avatar_hash = avatar_hash
+
+    avatar = User.avatar
+
+
+# the Post attributes _post.html and the fragment cache read
+class RecentPost:
+    __slots__ = ('id', 'body', 'timestamp', 'language', 'version', 'author')
+
+    def __init__(self, id, body, timestamp, language, version, author):
+        self.id = id
+        self.body = body
+        # stored naive UTC, like the database returns it
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        self.timestamp = timestamp
+        self.language = language
+        self.version = version
+        self.author = author
+
+    @classmethod
+    def from_post(cls, post):
+        # a post created with only user_id has no author until it is loaded again
+        author = post.author or db.session.get(User, post.user_id)
+        return cls(post.id, post.body, post.timestamp, post.language, post.version,
+                   RecentAuthor(author.id, author.username, author.avatar_hash))
+
+    @property
+    def key(self):
+        return (self.timestamp, self.id)
+
+
+# posts are never changed in place, views handed out earlier keep theirs
+def _replace(post, **values):
+    fields = {name: getattr(post, name) for name in RecentPost.__slots__}
+    fields.update(values)
+    return RecentPost(**fields)
+
+
+# an immutable copy of the buffer, oldest first, handed to readers
+class RecentView:
+    def __init__(self, posts, complete, version, modified):
+        self.rows = [(post, post.timestamp, post.id) for post in posts]
+        self.keys = [post.key for post in posts]
+        self.complete = complete # the buffer holds every post there is
+        self.latest = (posts[-1].id, posts[-1].timestamp) if posts else None
+        # the shared sequence number this copy reflects, the explore ETag: unlike
+        # the newest post it also changes with author renames and languages
+        self.version = version
+        self.modified = modified  # when this worker last saw the version change
+
+    # a KeysetPage of RecentPost, or None if the page is outside the buffer
+    def page(self, cursor, per_page):
+        return keyset_window(self.rows, self.keys, cursor, per_page, self.complete)
+
+
+class RecentPosts:
+    def __init__(self, app):
+        self.app = app
+        self.size = app.config['RECENT_POSTS_SIZE']
+        self.path = app.config['RECENT_POSTS_SEQUENCE_FILE'] or \
+            os.path.join(app.instance_path, 'recent_posts.seq')
+        self._lock = threading.Lock()
+        self._posts = []  # oldest first
+        self._complete = False
+        self._view = None
+        self._sequence = None
+        self._modified = None
+        self._pid = None
+
+    # fills the buffer on the first request of each worker
+    def start(self):
+        if not self.size or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.current()
+
+    # the buffer, reloaded if another process changed posts since; None when off
+    def current(self):
+        if not self.size:
+            return None
+        sequence = self._read_sequence()
+        view = self._view
+        if view is None or sequence != self._sequence:
+            view = self.load(sequence)
+        return view
+
+    def load(self, sequence=None):
+        if sequence is None:
+            sequence = self._read_sequence()
+        rows = db.session.execute(
+            sa.select(Post.id, Post.body, Post.timestamp, Post.language, Post.version,
+                      User.id, User.username, User.avatar_hash)
+            .join(Post.author).order_by(Post.timestamp.desc(), Post.id.desc())
+            .limit(self.size + 1),
+            # always the primary, a lagging replica would be cached until the next change
+            bind_arguments={'bind': db.engine}).all()
+        posts = [RecentPost(*row[:5], RecentAuthor(*row[5:])) for row in rows[:self.size]]
+        posts.reverse()
+        with self._lock:
+            self._posts = posts
+            self._complete = len(rows) <= self.size
+            self._sequence = sequence
+            self._modified = datetime.now(timezone.utc)
+            self._view = RecentView(posts, self._complete, sequence, self._modified)
+            return self._view
+
+    # changes committed by this process: ('post', RecentPost), ('delete', id),
+    # ('author', RecentAuthor) or ('language', id, language)
+    def apply(self, changes):
+        if not self.size:
+            return
+        with self._lock:
+            sequence = self._bump_sequence(self._apply_locked, changes)
+            # still the old sequence if the changes were not applied here
+            self._view = RecentView(self._posts, self._complete, self._sequence,
+                                    self._modified)
+            return sequence
+
+    # for bulk changes made with Core statements: every worker reloads
+    def invalidate(self):
+        if not self.size:
+            return
+        with self._lock:
+            self._bump_sequence()
+
+    def _apply_locked(self, changes):
+        for change in changes:
+            kind = change[0]
+            if kind == 'post':
+                self._remove(change[1].id)
+                self._insert(change[1])
+            elif kind == 'delete':
+                self._remove(change[1])
+            elif kind == 'author':
+                self._posts = [_replace(post, author=change[1])
+                               if post.author.id == change[1].id else post
+                               for post in self._posts]
+            elif kind == 'language':
+                self._posts = [_replace(post, language=change[2])
+                               if post.id == change[1] else post for post in self._posts]
+
+    def _remove(self, post_id):
+        self._posts = [post for post in self._posts if post.id != post_id]
+
+    def _insert(self, post):
+        keys = [p.key for p in self._posts]
+        if keys and post.key < keys[0] and not self._complete and \
+                len(self._posts) >= self.size:
+            return  # older than anything kept
+        position = bisect_left(keys, post.key)
+        self._posts = self._posts[:position] + [post] + self._posts[position:]
+        if len(self._posts) > self.size:
+            del self._posts[0]
+            self._complete = False
+
+    # --- change sequence shared by the workers ---
+
+    def _read_sequence(self):
+        try:
+            with open(self.path) as f:
+                return f.read()
+        except OSError:
+            return ''
+
+    # increments the sequence under an exclusive lock. If this process was up to
+    # date, `apply` updates the buffer and the new number is recorded as seen;
+    # otherwise the buffer stays stale and the next current() reloads it
+    def _bump_sequence(self, apply=None, changes=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            old = f.read()
+            try:
+                new = str(int(old) + 1)
+            except ValueError:
+                new = '1'
+            f.seek(0)
+            f.truncate()
+            f.write(new)
+            f.flush()
+        if apply is not None and self._view is not None and old == self._sequence:
+            apply(changes)
+            self._sequence = new
+            self._modified = datetime.now(timezone.utc)
+        return new
+
+
+# session hooks, see Post.track_recent
+def changes_from_flush(session):
+    changes = []
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Post):
+            changes.append(('post', RecentPost.from_post(obj)))
+        elif isinstance(obj, User) and obj in session.dirty:
+            state = sa.inspect(obj)
+            if state.attrs.username.history.has_changes() or \
+                    state.attrs.avatar_hash.history.has_changes():
+                changes.append(('author', RecentAuthor(obj.id, obj.username, obj.avatar_hash)))
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            changes.append(('delete', obj.id))
+    return changes
@@ -0,0 +1,73 @@
+import random
+import time
+from functools import wraps
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from app.streaming import after_body
+
+# read replicas are the SQLALCHEMY_BINDS named replica<N>. Views marked
+# @read_only send their SELECTs to one of them; a client that wrote recently
+# is pinned to the primary for REPLICA_STICKY_SECONDS so it reads its own writes
+
+
+def replica_keys(app=None):
+    app = app or current_app
+    return [key for key in app.config.get('SQLALCHEMY_BINDS') or {}
+            if key.startswith('replica')]
+
+
+def _sticky():
+    return session.get('_db_sticky_until', 0) > time.time()
+
+
+def read_only(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        keys = replica_keys()
+        if not keys or request.method not in ('GET', 'HEAD') or _sticky():
+            return f(*args, **kwargs)
+        # dropped by _forget_replica(), a streamed page queries while rendering
+        g.db_replica = random.choice(keys)
+        return f(*args, **kwargs)
+    return decorated
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and clause is not None and \
+                getattr(clause, 'is_select', False) and has_request_context():
+            key = g.get('db_replica')
+            if key is not None:
+                return self._db.engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+# session events: any write during a request makes the client sticky
+def _wrote(*args):
+    if has_request_context():
+        g.db_wrote = True
+
+def _orm_execute(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or \
+            orm_execute_state.is_delete:
+        _wrote()
+
+def _set_sticky(response):
+    if g.pop('db_wrote', False):
+        session['_db_sticky_until'] = time.time() + current_app.config['REPLICA_STICKY_SECONDS']
+    return response
+
+def _forget_replica(response):
+    state = g._get_current_object()
+    return after_body(response, lambda: state.pop('db_replica', None))
+
+
+def init_app(app, db):
+    if not replica_keys(app):
+        return
+    # session events are global, register them once for all apps
+    if not db.event.contains(db.session, 'after_flush', _wrote):
+        db.event.listen(db.session, 'after_flush', _wrote)
+        db.event.listen(db.session, 'do_orm_execute', _orm_execute)
+    app.after_request(_set_sticky)
+    app.after_request(_forget_replica)
@@ -1,85 +1,429 @@
+import json
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import monotonic
 from flask import current_app
 import sqlalchemy as sa
 from app import db
+from app.pagination import encode_cursor, decode_cursor, keyset_paginate
+from app.outbox import claim, done, retry_later
+from app.metrics import external_call
 
-# adds/updates a document in an Elasticsearch index
-def add_to_index(index, model):
-    # check when Elasticsearch server not configured
-    es = current_app.elasticsearch
-    if not es:
-        return
+# JSON document body will send to ES
+def _document(model):
     payload = {}
     for field in model.__searchable__:
-        # JSON document body will send to ES
         payload[field] = getattr(model, field)
+    return payload
 
-    try:
-        # refresh so searches see docs immediately (safe to omit)
-        es.index(index=index, id=model.id, document=payload, refresh="wait_for")
-    except Exception as e:   
-        # same id value, link teo databases  
-        current_app.logger.warning("Search indexing skipped: %s", e)
+# --- Local index: SQLite FTS5 tables mirroring the __searchable__ fields ---
+# Used when Elasticsearch is missing or down, ranked by bm25. Elasticsearch
+# itself is fed through the outbox (drain_outbox) and bulk_reindex.
+
+def _fts_table(index):
+    return f'{index}_fts'
+
+def register_local_index(model):
+    table = _fts_table(model.__tablename__)
+    sa.event.listen(model.__table__, 'after_create', sa.DDL(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5("
+        f"{', '.join(model.__searchable__)}, tokenize='unicode61 remove_diacritics 2')"
+    ).execute_if(dialect='sqlite'))
+    sa.event.listen(model.__table__, 'before_drop', sa.DDL(
+        f'DROP TABLE IF EXISTS {table}').execute_if(dialect='sqlite'))
+
+def local_index_enabled():
+    return current_app.config.get('SEARCH_LOCAL_INDEX', True) and \
+        db.session.get_bind().dialect.name == 'sqlite'
+
+# adds/updates a document in the local index, in the caller's transaction
+def add_to_index(index, model):
+    if not local_index_enabled():
+        return
+    remove_from_index(index, model)
+    fields = model.__searchable__
+    db.session.execute(sa.text(
+        f"INSERT INTO {_fts_table(index)} (rowid, {', '.join(fields)}) "
+        f"VALUES (:id, {', '.join(':' + field for field in fields)})"),
+        {'id': model.id, **_document(model)})
 
 # deletes document stored under given id
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    if not local_index_enabled():
         return
+    db.session.execute(sa.text(f'DELETE FROM {_fts_table(index)} WHERE rowid = :id'),
+                       {'id': model.id})
+
+# repopulates the local index from the table, e.g. after a bulk import
+def rebuild_local_index(model):
+    if not local_index_enabled():
+        raise RuntimeError('The local search index needs SQLite')
+    index, fields = model.__tablename__, ', '.join(model.__searchable__)
+    db.session.execute(sa.text(f'DELETE FROM {_fts_table(index)}'))
+    db.session.execute(sa.text(
+        f'INSERT INTO {_fts_table(index)} (rowid, {fields}) '
+        f'SELECT id, {fields} FROM {index}'))
+    db.session.commit()
+    return db.session.scalar(sa.text(f'SELECT count(*) FROM {_fts_table(index)}'))
+
+# bm25-ranked ids, paged with a (rank, rowid) keyset cursor
+def _local_query_index(index, query, per_page, cursor=None):
+    # quote every word so user input can't use FTS5 query syntax; any word matches
+    terms = ' OR '.join('"{}"'.format(term) for term in re.findall(r'\w+', query))
+    if not terms:
+        return [], None, None
+    table = _fts_table(index)
+    params = {'q': terms, 'n': per_page + 1}
+
+    data = decode_cursor(cursor)
     try:
-        current_app.elasticsearch.delete(index=index, id=model.id, ignore=[404], refresh="wait_for")
+        params['r'], params['i'] = float(data['r']), int(data['i'])
+    except (TypeError, KeyError, ValueError):
+        data = None
+    backwards = data is not None and data.get('d') == 'prev'
+    if data is None:
+        where, order = '', 'rank, rowid'
+    elif backwards:
+        where, order = 'AND (rank < :r OR (rank = :r AND rowid < :i))', 'rank DESC, rowid DESC'
+    else:
+        where, order = 'AND (rank > :r OR (rank = :r AND rowid > :i))', 'rank, rowid'
+    rows = db.session.execute(sa.text(
+        f'SELECT rowid, rank FROM {table} WHERE {table} MATCH :q {where} '
+        f'ORDER BY {order} LIMIT :n'), params).all()
+
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    next_cursor = prev_cursor = None
+    if rows and (more or backwards):
+        next_cursor = encode_cursor({'r': rows[-1][1], 'i': rows[-1][0], 'd': 'next'})
+    if rows and (more if backwards else data is not None):
+        prev_cursor = encode_cursor({'r': rows[0][1], 'i': rows[0][0], 'd': 'prev'})
+    return [row[0] for row in rows], next_cursor, prev_cursor
+
+# sends the changes queued by SearchableMixin in bulk requests, runs in the
+# background indexer thread; failed documents stay queued and are retried
+def drain_outbox():
+    from app.models import SearchableMixin, SearchOutbox  # local import to avoid circulars
+    es = current_app.elasticsearch
+    if not es:
+        return 0
+    models = {cls.__tablename__: cls for cls in SearchableMixin.__subclasses__()}
+    sent = 0
+    while True:
+        rows = claim(SearchOutbox, current_app.config['SEARCH_OUTBOX_BATCH'])
+        if not rows:
+            return sent
+
+        # coalesce: only the latest change of each document matters
+        latest, queued = {}, {}
+        for row in rows:
+            latest[(row.index_name, row.object_id)] = row.op
+            queued.setdefault((row.index_name, row.object_id), []).append(row)
+        objects = {}
+        for index, model in models.items():
+            ids = [id for (name, id), op in latest.items() if name == index and op == 'index']
+            if ids:
+                for obj in db.session.scalars(sa.select(model).where(model.id.in_(ids))):
+                    objects[(index, obj.id)] = obj
+
+        keys, operations = [], []
+        for key in latest:
+            keys.append(key)
+            if key in objects:
+                operations.append({'index': {'_index': key[0], '_id': key[1]}})
+                operations.append(_document(objects[key]))
+            else:
+                # deleted, or gone since it was queued
+                operations.append({'delete': {'_index': key[0], '_id': key[1]}})
+
+        try:
+            with external_call('elasticsearch'):
+                response = es.bulk(operations=operations)
+        except Exception as e:
+            current_app.logger.warning("Search bulk request failed, will retry: %s", e)
+            retry_later(rows, e)
+            db.session.commit()
+            return sent
+
+        # items come back in request order
+        for key, item in zip(keys, response['items']):
+            (action, result), = item.items()
+            status = result.get('status', 500)
+            if status < 300 or (action == 'delete' and status == 404):
+                done(queued[key])
+                sent += 1
+            else:
+                current_app.logger.error("Search indexing of %s/%s failed: %s",
+                                         key[0], key[1], result.get('error'))
+                retry_later(queued[key], result.get('error'))
+        db.session.commit()
+
+def _send_chunk(es, index, chunk):
+    operations = []
+    for obj in chunk:
+        operations.append({'index': {'_index': index, '_id': obj['id']}})
+        operations.append(obj['document'])
+    response = es.bulk(operations=operations)
+    if response.get('errors'):
+        errors = [item['index'] for item in response['items'] if item['index'].get('error')]
+        raise RuntimeError('{} document(s) failed, first: {}'.format(len(errors), errors[0]))
+    return len(chunk)
+
+def _swap_alias(es, alias, target):
+    actions = [{'add': {'index': target, 'alias': alias}}]
+    if es.indices.exists_alias(name=alias):
+        for old in es.indices.get_alias(name=alias):
+            actions.insert(0, {'remove': {'index': old, 'alias': alias}})
+    elif es.indices.exists(index=alias):
+        # first rebuild: the alias replaces a concrete index of the same name
+        actions.insert(0, {'remove_index': {'index': alias}})
+    es.indices.update_aliases(actions=actions)
+
+# rebuilds the index of a SearchableMixin model: rows are streamed in id order
+# with yield_per, sent as bulk requests by `concurrency` threads, with refresh
+# disabled on the target. With swap=True the documents go to a new index and
+# the alias is switched atomically at the end. The last indexed id is kept in
+# the target's mapping _meta so an interrupted build can resume.
+def bulk_reindex(model, chunk_size=1000, concurrency=4, swap=False, target=None,
+                 resume=False, progress=None):
+    es = current_app.elasticsearch
+    if es is None:
+        raise RuntimeError('Elasticsearch is not configured')
+    alias = model.__tablename__
+    if target is None:
+        target = '{}_{}'.format(alias, datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')) \
+            if swap else alias
+    if not es.indices.exists(index=target):
+        es.indices.create(index=target)
+
+    last_id = 0
+    if resume:
+        meta = es.indices.get_mapping(index=target)
+        meta = next(iter(meta.values()))['mappings'].get('_meta', {})
+        last_id = meta.get('reindex_last_id', 0)
+    es.indices.put_settings(index=target, settings={'index': {'refresh_interval': '-1'}})
+
+    stmt = sa.select(model).where(model.id > last_id).order_by(model.id) \
+        .execution_options(yield_per=chunk_size)
+    count, started = 0, monotonic()
+    pending = deque()
+
+    def finish(chunk_last_id, future):
+        nonlocal count, last_id
+        count += future.result()
+        # chunks complete in order, everything up to here is indexed
+        last_id = chunk_last_id
+        es.indices.put_mapping(index=target, meta={'reindex_last_id': last_id})
+        if progress:
+            progress(count, last_id, monotonic() - started)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            try:
+                for partition in db.session.scalars(stmt).partitions():
+                    # documents are built here, the session is not shared with the pool
+                    chunk = [{'id': obj.id, 'document': _document(obj)} for obj in partition]
+                    pending.append((chunk[-1]['id'], pool.submit(_send_chunk, es, target, chunk)))
+                    if len(pending) >= concurrency:
+                        finish(*pending.popleft())
+                while pending:
+                    finish(*pending.popleft())
+            except BaseException:
+                for _, future in pending:
+                    future.cancel()
+                raise
+    finally:
+        es.indices.put_settings(index=target, settings={'index': {'refresh_interval': None}})
+    es.indices.refresh(index=target)
+    if swap:
+        _swap_alias(es, alias, target)
+    return target, count
+
+# --- Elasticsearch paging: point in time + search_after ---
+# One request fetches SEARCH_PREFETCH_PAGES pages of ids (a block) from a point
+# in time, sorted by (_score, _shard_doc). Blocks are kept in app.search_results
+# for SEARCH_CACHE_TTL seconds, so moving between the pages of a block costs no
+# cluster round trip, and the next block continues with search_after from its
+# last hit: no from_, no result window limit. Totals are counted up to
+# SEARCH_TRACK_TOTAL_HITS only. Page tokens carry the point in time their sort
+# values belong to ('p') and either {'a': sort values the block starts after,
+# 'o': offset in the block} or {'b': sort values, 'd': 'prev'} for the page just
+# before that hit. If that point in time is gone, paging starts over.
+
+# a point in time (PIT) is a snapshot of the whole index, so one per index and
+# worker serves every query and a new query costs a single round trip. It is
+# replaced every SEARCH_CACHE_TTL seconds so new posts show up; the one before
+# stays open for cursors still paging through it, older ones are closed.
+class PointsInTime:
+    def __init__(self, app):
+        self.app = app
+        self._current = {}   # index -> (pit id, opened at)
+        self._previous = {}  # index -> pit id
+        self._lock = threading.Lock()
+
+    def get(self, es, index):
+        with self._lock:
+            pit = self._current.get(index)
+            if pit is not None and monotonic() - pit[1] < self.app.config['SEARCH_CACHE_TTL']:
+                return pit[0]
+        with external_call('elasticsearch'):
+            new = es.open_point_in_time(
+                index=index, keep_alive=self.app.config['SEARCH_PIT_KEEP_ALIVE'])['id']
+        with self._lock:
+            pit = self._current.get(index)
+            if pit is not None and monotonic() - pit[1] < self.app.config['SEARCH_CACHE_TTL']:
+                # another thread replaced it meanwhile
+                closed, new = new, pit[0]
+            else:
+                closed = self._previous.pop(index, None)
+                if pit is not None:
+                    self._previous[index] = pit[0]
+                self._current[index] = (new, monotonic())
+        self._close(es, closed)
+        return new
+
+    # a PIT the cluster no longer knows (expired or closed)
+    def discard(self, index, pit):
+        with self._lock:
+            if self._current.get(index, (None,))[0] == pit:
+                del self._current[index]
+            if self._previous.get(index) == pit:
+                del self._previous[index]
+
+    def _close(self, es, pit):
+        if pit is None:
+            return
+        try:
+            with external_call('elasticsearch'):
+                es.close_point_in_time(id=pit)
+        except Exception as e:
+            # expires on its own after SEARCH_PIT_KEEP_ALIVE
+            self.app.logger.info('Closing point in time failed: %s', e)
+
+def _pit_missing(error):
+    return getattr(error, 'status_code', None) == 404
+
+def _es_search(es, query, size, after, pit, reverse=False):
+    config = current_app.config
+    order = 'asc' if reverse else 'desc'
+    body = {
+        'query': {'multi_match': {'query': query, 'fields': ['*']}},
+        'sort': [{'_score': order}, {'_shard_doc': order}],
+        'size': size,
+        'track_total_hits': config['SEARCH_TRACK_TOTAL_HITS'],
+    }
+    if after is not None:
+        body['search_after'] = after
+    with external_call('elasticsearch'):
+        response = es.search(pit={'id': pit, 'keep_alive': config['SEARCH_PIT_KEEP_ALIVE']},
+                             **body)
+    return response['hits']['hits']
+
+def _block(es, index, query, per_page, after, pit):
+    key = ('block', index, query, per_page, pit, json.dumps(after))
+    block = current_app.search_results.get(key)
+    if block is None:
+        size = per_page * current_app.config['SEARCH_PREFETCH_PAGES']
+        hits = _es_search(es, query, size + 1, after, pit)
+        block = {
+            'ids': [int(hit['_id']) for hit in hits[:size]],
+            'first': hits[0]['sort'] if hits else None,
+            'last': hits[min(size, len(hits)) - 1]['sort'] if hits else None,
+            'more': len(hits) > size,
+        }
+        current_app.search_results.set(key, block)
+    return block
+
+def _es_page(es, index, query, per_page, pit, after, offset):
+    block = _block(es, index, query, per_page, after, pit)
+    ids = block['ids'][offset:offset + per_page]
+    next_cursor = prev_cursor = None
+    if offset + per_page < len(block['ids']):
+        next_cursor = encode_cursor({'p': pit, 'a': after, 'o': offset + per_page})
+    elif block['more']:
+        next_cursor = encode_cursor({'p': pit, 'a': block['last'], 'o': 0})
+    if offset > 0:
+        prev_cursor = encode_cursor({'p': pit, 'a': after, 'o': max(offset - per_page, 0)})
+    elif after is not None and block['first'] is not None:
+        prev_cursor = encode_cursor({'p': pit, 'b': block['first'], 'd': 'prev'})
+    return ids, next_cursor, prev_cursor
+
+# the page before a hit: search_after in reverse order
+def _es_prev_page(es, query, per_page, pit, before):
+    hits = _es_search(es, query, per_page + 1, before, pit, reverse=True)
+    more = len(hits) > per_page
+    hits = hits[:per_page][::-1]
+    if not hits:
+        return [], None, None
+    next_cursor = encode_cursor({'p': pit, 'a': hits[-1]['sort'], 'o': 0})
+    prev_cursor = encode_cursor({'p': pit, 'b': hits[0]['sort'], 'd': 'prev'}) \
+        if more else None
+    return [int(hit['_id']) for hit in hits], next_cursor, prev_cursor
+
+def _es_query_index(es, index, query, per_page, cursor=None):
+    pits = current_app.search_pits
+    data = decode_cursor(cursor) or {}
+    pit = data.get('p') if isinstance(data.get('p'), str) else None
+    if pit is not None:
+        try:
+            if data.get('d') == 'prev' and isinstance(data.get('b'), list):
+                return _es_prev_page(es, query, per_page, pit, data['b'])
+            after = data.get('a') if isinstance(data.get('a'), list) else None
+            try:
+                offset = max(int(data.get('o', 0)), 0)
+            except (TypeError, ValueError):
+                offset = 0
+            return _es_page(es, index, query, per_page, pit, after, offset)
+        except Exception as e:
+            if not _pit_missing(e):
+                raise
+            # sort values only mean something in their own PIT: start over
+            pits.discard(index, pit)
+
+    pit = pits.get(es, index)
+    try:
+        return _es_page(es, index, query, per_page, pit, None, 0)
     except Exception as e:
-        current_app.logger.warning("Search delete skipped: %s", e)
-
-# takes index name and text to search for
-def query_index(index, query, page, per_page):
-    #if not current_app.elasticsearch:
-        #return [], 0
-    #search = current_app.elasticsearch.search(
-        #index=index,
-        # search across multiple fields
-        #query={'multi_match': {'query': query, 'fields': ['*']}},
-        #from_=(page - 1) * per_page,
-        #size=per_page)
-    #ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    #return ids, search['hits']['total']['value']
+        if not _pit_missing(e):
+            raise
+        # expired while idle, retried once in a new one
+        pits.discard(index, pit)
+        return _es_page(es, index, query, per_page, pits.get(es, index), None, 0)
+
+# takes index name and text to search for, returns ids plus next/prev page tokens
+def query_index(index, query, per_page, cursor=None):
     es = current_app.elasticsearch
 
     # --- Preferred path: Elasticsearch ---
     if es:
         try:
-            search = es.search(
-                index=index,
-                # search across multiple fields
-                query={'multi_match': {'query': query, 'fields': ['*']}},
-                from_=(page - 1) * per_page,
-                size=per_page
-            )
-            ids = [int(hit['_id']) for hit in search['hits']['hits']]
-            return ids, search['hits']['total']['value']
+            return _es_query_index(es, index, query, per_page, cursor)
         except Exception as e:
             current_app.logger.warning("ES search failed, falling back to SQL: %s", e)
 
+    # --- Local path: SQLite FTS5 ---
+    if local_index_enabled():
+        try:
+            return _local_query_index(index, query, per_page, cursor)
+        except Exception as e:
+            current_app.logger.warning("Local search failed, falling back to LIKE: %s", e)
+
     # --- Fallback path: simple SQL LIKE (posts only) ---
     try:
         from app.models import Post  # local import to avoid circulars
         # accept "post", "posts", or the model's table name
         if index not in ('post', 'posts', getattr(Post, '__tablename__', 'post')):
-            return [], 0
-
-        # ids page slice
-        stmt = (sa.select(Post.id)
-                  .where(Post.body.ilike(f"%{query}%"))
-                  .order_by(Post.timestamp.desc())
-                  .offset((page - 1) * per_page)
-                  .limit(per_page))
-        ids = [row[0] for row in db.session.execute(stmt)]
-
-        # total count
-        total_stmt = sa.select(sa.func.count()).select_from(
-            sa.select(Post.id).where(Post.body.ilike(f"%{query}%")).subquery()
-        )
-        total = db.session.scalar(total_stmt) or 0
-
-        return ids, total
+            return [], None, None
+
+        # keyset page of ids, no total count needed
+        page = keyset_paginate(sa.select(Post.id).where(Post.body.ilike(f"%{query}%")),
+                               (Post.timestamp, Post.id), cursor, per_page)
+        return page.items, page.next_cursor, page.prev_cursor
     except Exception as e:
         current_app.logger.warning("SQL fallback search failed: %s", e)
-        return [], 0
+        return [], None, None
@@ -0,0 +1,96 @@
+import secrets
+from flask import has_request_context, session
+from flask_login import UserMixin
+from app import db
+from app.cache import TTLCache
+from app.models import User
+
+# The logged-in user without a query per request: the loader hands out a
+# SessionUser built from a per-worker snapshot of the columns pages read. The
+# User row is loaded the first time a view needs anything else (follow(),
+# assigning username, ...). Snapshots are keyed by (id, version, generation):
+# a commit that changes a user bumps its generation in this worker, and if it
+# is the session's own user also the version kept in the session cookie, so
+# the next request misses in every worker. Other sessions of that user see the
+# change in other workers after SESSION_USER_CACHE_TTL seconds at most.
+
+VERSION_KEY = '_user_version'
+
+
+class UserSnapshot:
+    __slots__ = ('id', 'username', 'avatar_hash', 'about_me', 'last_seen', 'follow_version')
+
+    def __init__(self, user):
+        for name in self.__slots__:
+            setattr(self, name, getattr(user, name))
+
+
+class SessionUser(UserMixin):
+    def __init__(self, snapshot):
+        object.__setattr__(self, '_snapshot', snapshot)
+        object.__setattr__(self, '_user', None)
+
+    def _load(self):
+        if self._user is None:
+            object.__setattr__(self, '_user', db.session.get(User, self._snapshot.id))
+        return self._user
+
+    # snapshot columns until the row is loaded, the row for everything else
+    def __getattr__(self, name):
+        if name in ('_snapshot', '_user'):
+            raise AttributeError(name)
+        if self._user is None and name in UserSnapshot.__slots__:
+            return getattr(self._snapshot, name)
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __eq__(self, other):
+        if isinstance(other, (User, SessionUser)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return '<SessionUser {}>'.format(self.username)
+
+    # read-only helpers that need no more than the snapshot
+    avatar = User.avatar
+    is_following = User.is_following
+    pulled_authors = User.pulled_authors
+    timeline_feed = User.timeline_feed
+    timeline_latest = User.timeline_latest
+    following_posts = User.following_posts
+
+
+class SessionUserCache:
+    def __init__(self, app):
+        self.app = app
+        self.size = app.config['SESSION_USER_CACHE_SIZE']
+        self._snapshots = TTLCache(self.size or 1, app.config['SESSION_USER_CACHE_TTL'])
+        self._generations = {}  # user id -> commits seen that changed the user
+
+    def _key(self, id):
+        return (id, session.get(VERSION_KEY), self._generations.get(id, 0))
+
+    # the login manager's user loader
+    def load(self, id):
+        if not self.size:
+            return db.session.get(User, id)
+        snapshot = self._snapshots.get(self._key(id))
+        if snapshot is not None:
+            return SessionUser(snapshot)
+        user = db.session.get(User, id)
+        if user is not None:
+            self._snapshots.set(self._key(id), UserSnapshot(user))
+        return user
+
+    # users changed by a commit of this process, see User.publish_changes
+    def invalidate(self, ids):
+        for id in ids:
+            self._generations[id] = self._generations.get(id, 0) + 1
+        if has_request_context() and session.get('_user_id') in {str(id) for id in ids}:
+            session[VERSION_KEY] = secrets.token_hex(4)
@@ -0,0 +1,71 @@
+import re
+import threading
+import sqlalchemy as sa
+from app import db
+
+# SQLite deployment profile (SQLITE_PROFILE=production): WAL and friends on every
+# new connection, and one writer at a time per worker process. SQLite allows a
+# single writer anyway; queueing threads on a lock here is cheaper and fairer
+# than having them spin on "database is locked" inside busy_timeout.
+
+_DML = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+
+
+def pragmas(config):
+    return {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': config['SQLITE_BUSY_TIMEOUT'],
+        'mmap_size': config['SQLITE_MMAP_SIZE'],
+        'cache_size': config['SQLITE_CACHE_SIZE'],
+    }
+
+
+class WriterLock:
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    # taken by the first write of a transaction, held until it ends
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if 'writer_lock' in conn.info or not _DML.match(statement):
+            return
+        # past the timeout go ahead anyway, busy_timeout still applies. The False
+        # stays until the transaction ends, its later writes don't wait again
+        conn.info['writer_lock'] = self._lock.acquire(timeout=self.timeout)
+
+    def _release(self, info):
+        if info.pop('writer_lock', False):
+            self._lock.release()
+
+    def _end(self, conn):
+        self._release(conn.info)
+
+    def _reset(self, dbapi_connection, connection_record, reset_state):
+        # returned to the pool without a commit or rollback event
+        self._release(connection_record.info)
+
+
+def configure_engine(engine, settings, writer_lock=None):
+    @sa.event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in settings.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    if writer_lock is not None:
+        sa.event.listen(engine, 'before_cursor_execute', writer_lock._before_cursor_execute)
+        sa.event.listen(engine, 'commit', writer_lock._end)
+        sa.event.listen(engine, 'rollback', writer_lock._end)
+        sa.event.listen(engine, 'reset', writer_lock._reset)
+
+
+def init_app(app):
+    if app.config.get('SQLITE_PROFILE') != 'production':
+        return
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite' and engine.url.database not in (None, '', ':memory:'):
+                configure_engine(engine, pragmas(app.config),
+                                 WriterLock(app.config['SQLITE_WRITE_LOCK_TIMEOUT']))
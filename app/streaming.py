@@ -0,0 +1,35 @@
+from flask import get_flashed_messages, stream_template
+from flask_wtf.csrf import generate_csrf
+
+# Streamed pages: the head and navbar go out before the posts are fetched.
+# Flask runs the after_request and teardown callbacks as soon as the view
+# returns, before a streamed body has been produced, so bookkeeping that has
+# to cover the whole body is deferred with after_body()
+
+
+# calls f() once the body has been sent, right away for a buffered response;
+# f runs outside the request context, it has to capture what it needs. Also
+# when the client goes away mid-stream and the server closes the body
+def after_body(response, f):
+    if not response.is_streamed:
+        f()
+        return response
+    body = response.response
+
+    def wrapped():
+        try:
+            yield from body
+        finally:
+            f()
+
+    response.response = wrapped()
+    return response
+
+# anything the page keeps in the session has to be there before the headers
+# (and the session cookie) go out: flashed messages are popped and the CSRF
+# token is created now, the template reads both back from the request
+def stream_page(template, **context):
+    get_flashed_messages()
+    if context.get('form') is not None:
+        generate_csrf()
+    return stream_template(template, **context)
@@ -1,22 +1,163 @@
+import hashlib
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app
 from flask_babel import _
-from app import current_app
+import sqlalchemy as sa
+from app import db
+from app.cache import LRUCache, SingleFlight
+from app.metrics import external_call
 
-def translate(text, source_language, dest_language):
-    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
-            not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation service is not configured.')
-    
+
+class TranslationError(Exception):
+    pass
+
+
+# one pooled HTTP session per worker process, so calls reuse TLS connections
+_session = None
+_session_lock = threading.Lock()
+
+def _http():
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=current_app.config['TRANSLATOR_POOL_SIZE'])
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+    return _session
+
+# texts per upstream request, the API accepts arrays of up to 1000 elements
+BATCH_SIZE = 100
+
+# level 1: per-worker LRU, level 2: the translation table shared by all workers
+_memory = LRUCache(1024)
+_flight = SingleFlight()
+
+def translation_key(text, source_language, dest_language):
+    return hashlib.sha256('\0'.join(
+        (source_language, dest_language, text)).encode('utf-8')).hexdigest()
+
+# translates a list of texts from one language in a single upstream request
+def _request(texts, source_language, dest_language):
     # provided in Keys and Endpoint page
     auth = {
         'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
-        'Ocp-Apim-Subscription-Region': 'uksouth',
+        'Ocp-Apim-Subscription-Region': current_app.config['MS_TRANSLATOR_REGION'],
     }
-    # path for the translation endpoint
-    r = requests.post( 
-        'https://api.cognitive.microsofttranslator.com'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[{'Text': text}]) # JSON sending structured data between a browser and a server.
+    try:
+        # path for the translation endpoint
+        with external_call('translator'):
+            r = _http().post(
+                current_app.config['MS_TRANSLATOR_ENDPOINT'].rstrip('/') + '/translate',
+                params={'api-version': '3.0', 'from': source_language, 'to': dest_language},
+                headers=auth, json=[{'Text': text} for text in texts],
+                timeout=current_app.config['TRANSLATOR_TIMEOUT'])
+    except requests.RequestException as e:
+        raise TranslationError(str(e))
     if r.status_code != 200:
+        raise TranslationError('HTTP {}'.format(r.status_code))
+    return [item['translations'][0]['text'] for item in r.json()]
+
+# INSERT that skips rows whose key is already stored
+def _insert_ignore(table, dialect):
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing(index_elements=['key'])
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert(table).on_conflict_do_nothing(index_elements=['key'])
+    if dialect in ('mysql', 'mariadb'):
+        return table.insert().prefix_with('IGNORE')
+    return None
+
+# saves {key: translated text} in both cache levels; the table is written on a
+# connection of its own, the request's session and its pending work are left alone
+def _store(translated, source_language, dest_language):
+    from app.models import Translation  # local import to avoid circulars
+    rows = [{'key': key, 'source_language': source_language,
+             'dest_language': dest_language, 'text': text}
+            for key, text in translated.items()]
+    try:
+        with db.engine.begin() as conn:
+            insert = _insert_ignore(Translation.__table__, conn.dialect.name)
+            if insert is not None:
+                conn.execute(insert, rows)
+            else:
+                for row in rows:
+                    # one savepoint per key, a duplicate only skips that key
+                    try:
+                        with conn.begin_nested():
+                            conn.execute(Translation.__table__.insert(), row)
+                    except sa.exc.IntegrityError:
+                        pass
+    except sa.exc.SQLAlchemyError as e:
+        # the cache is best effort
+        current_app.logger.warning('Storing translations failed: %s', e)
+    for key, text in translated.items():
+        _memory.set(key, text)
+
+def _translate(key, text, source_language, dest_language):
+    from app.models import Translation  # local import to avoid circulars
+    cached = db.session.get(Translation, key)
+    if cached is not None:
+        _memory.set(key, cached.text)
+        return cached.text
+    translated = _request([text], source_language, dest_language)[0]
+    _store({key: translated}, source_language, dest_language)
+    return translated
+
+def translate(text, source_language, dest_language):
+    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
+            not current_app.config['MS_TRANSLATOR_KEY']:
+        return _('Error: the translation service is not configured.')
+
+    key = translation_key(text, source_language, dest_language)
+    cached = _memory.get(key)
+    if cached is not None:
+        return cached
+    try:
+        # concurrent requests for the same text share one lookup and API call
+        return _flight.do(key, lambda: _translate(key, text, source_language, dest_language))
+    except TranslationError as e:
+        current_app.logger.warning('Translation failed: %s', e)
         return _('Error: the translation service failed.')
-    return r.json()[0]['translations'][0]['text']
\ No newline at end of file
+
+# translates many texts from one language: cached ones are served from memory
+# or one IN query, the rest go upstream in as few array requests as possible
+def translate_many(texts, source_language, dest_language):
+    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
+            not current_app.config['MS_TRANSLATOR_KEY']:
+        return [_('Error: the translation service is not configured.')] * len(texts)
+    from app.models import Translation  # local import to avoid circulars
+
+    keys = [translation_key(text, source_language, dest_language) for text in texts]
+    found = {}
+    for key in keys:
+        cached = _memory.get(key)
+        if cached is not None:
+            found[key] = cached
+    missing = [key for key in set(keys) if key not in found]
+    if missing:
+        for row in db.session.scalars(sa.select(Translation).where(Translation.key.in_(missing))):
+            found[row.key] = row.text
+            _memory.set(row.key, row.text)
+
+    todo = {}
+    for key, text in zip(keys, texts):
+        if key not in found:
+            todo[key] = text
+    todo = list(todo.items())
+    try:
+        for i in range(0, len(todo), BATCH_SIZE):
+            chunk = todo[i:i + BATCH_SIZE]
+            results = _request([text for key, text in chunk], source_language, dest_language)
+            translated = {key: result for (key, text), result in zip(chunk, results)}
+            _store(translated, source_language, dest_language)
+            found.update(translated)
+    except TranslationError as e:
+        current_app.logger.warning('Translation failed: %s', e)
+    failed = _('Error: the translation service failed.')
+    return [found.get(key, failed) for key in keys]
@@ -0,0 +1,51 @@
+"""Per-page cost of avatar URLs: hashing the email on every call vs the
+stored avatar_hash column.
+
+    python benchmarks/avatar_hash.py [--posts 25] [--repeat 2000]
+"""
+import argparse
+import os
+import sys
+import timeit
+from hashlib import md5
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from app.models import User  # noqa: E402
+
+
+def hashed_avatar(user, size):
+    # User.avatar() before the avatar_hash column
+    digest = md5(user.email.lower().encode('utf-8')).hexdigest()
+    return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=25, help='posts per page')
+    parser.add_argument('--repeat', type=int, default=2000, help='pages rendered')
+    args = parser.parse_args()
+
+    users = [User(username=f'user{i}', email=f'User{i}@Example.com')
+             for i in range(args.posts)]
+
+    # a listing page: one small avatar per post plus the profile header
+    def page_before():
+        for user in users:
+            hashed_avatar(user, 70)
+        hashed_avatar(users[0], 256)
+
+    def page_after():
+        for user in users:
+            user.avatar(70)
+        users[0].avatar(256)
+
+    before = min(timeit.repeat(page_before, number=args.repeat, repeat=5)) / args.repeat
+    after = min(timeit.repeat(page_after, number=args.repeat, repeat=5)) / args.repeat
+    print(f'{args.posts} posts per page')
+    print(f'md5 per call:    {before * 1e6:8.1f} us/page')
+    print(f'stored digest:   {after * 1e6:8.1f} us/page')
+    print(f'saving:          {(before - after) * 1e6:8.1f} us/page ({before / after:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
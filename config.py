@@ -9,6 +9,17 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
+    # comma-separated read replica URLs, used by views marked @read_only
+    SQLALCHEMY_BINDS = {f'replica{i}': url.strip() for i, url in enumerate(
+        (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',')) if url.strip()}
+    # after writing, a client reads from the primary for this many seconds
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS') or 10)
+    # 'production' turns on WAL, tuned pragmas and one writer at a time per worker
+    SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE')
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000) # ms
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024)
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or -64000) # negative = KiB
+    SQLITE_WRITE_LOCK_TIMEOUT = int(os.environ.get('SQLITE_WRITE_LOCK_TIMEOUT') or 30)
 
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
@@ -17,9 +28,52 @@ class Config:
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = [os.environ.get('ADMIN_EMAIL')] if os.environ.get('ADMIN_EMAIL') else []
     EMAIL_ENABLED = os.environ.get("EMAIL_ENABLED", "1") == "1"
+    # queued mail is sent by MAIL_SENDER_THREADS workers, MAIL_OUTBOX_BATCH messages
+    # per SMTP connection
+    MAIL_SENDER_THREADS = int(os.environ.get('MAIL_SENDER_THREADS') or 2)
+    MAIL_OUTBOX_BATCH = int(os.environ.get('MAIL_OUTBOX_BATCH') or 50)
+    MAIL_OUTBOX_INTERVAL = int(os.environ.get('MAIL_OUTBOX_INTERVAL') or 30)
+    # a message refused this many times (or refused with a 5xx reply) is marked failed
+    MAIL_MAX_ATTEMPTS = int(os.environ.get('MAIL_MAX_ATTEMPTS') or 10)
     
     POSTS_PER_PAGE = 25
+    # timeline pages are streamed, posts are fetched and rendered this many at a time
+    POSTS_STREAM_BATCH = int(os.environ.get('POSTS_STREAM_BATCH') or 10)
+    # newest posts kept in every worker for explore (0 = off); workers notice each
+    # other's changes through a sequence file, instance/recent_posts.seq by default
+    RECENT_POSTS_SIZE = int(os.environ.get('RECENT_POSTS_SIZE') or 500)
+    RECENT_POSTS_SEQUENCE_FILE = os.environ.get('RECENT_POSTS_SEQUENCE_FILE')
+    API_MAX_PER_PAGE = 100
+    # logged-in users are loaded from per-worker snapshots (0 = off), other workers
+    # see a change to a user after SESSION_USER_CACHE_TTL seconds at most
+    SESSION_USER_CACHE_SIZE = int(os.environ.get('SESSION_USER_CACHE_SIZE') or 1000)
+    SESSION_USER_CACHE_TTL = int(os.environ.get('SESSION_USER_CACHE_TTL') or 60)
+    # daemon threads for write-behind and outbox work (tests drain by hand)
+    BACKGROUND_WORKERS = os.environ.get('BACKGROUND_WORKERS', '1') == '1'
+    LANGDETECT_WORKERS = int(os.environ.get('LANGDETECT_WORKERS') or 1)
+    # last_seen is buffered per worker, written at most every LAST_SEEN_FLUSH_INTERVAL
+    # seconds (or once LAST_SEEN_FLUSH_THRESHOLD users are pending), with
+    # LAST_SEEN_GRANULARITY seconds of resolution
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 30)
+    LAST_SEEN_FLUSH_THRESHOLD = int(os.environ.get('LAST_SEEN_FLUSH_THRESHOLD') or 500)
+    # debug/test guard, requests issuing more SQL statements than this fail (0 = off)
+    SQL_QUERY_LIMIT = int(os.environ.get('SQL_QUERY_LIMIT') or 0)
+    # authors with more followers than this are merged into timelines at read time
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 1000)
     LANGUAGES = ['en', 'zh_Hans', 'es']
+    # per-endpoint histograms served on /metrics (Prometheus text format); under
+    # several workers set METRICS_DIR to a directory shared by them
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_WRITE_INTERVAL = int(os.environ.get('METRICS_WRITE_INTERVAL') or 10)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # log requests slower than this many seconds along with their SQL (0 = off)
+    METRICS_SLOW_REQUEST = float(os.environ.get('METRICS_SLOW_REQUEST') or 0)
+    # rendered post fragments: 'memory' (per worker), 'filesystem' (shared) or 'none'
+    POST_FRAGMENT_CACHE = os.environ.get('POST_FRAGMENT_CACHE') or 'memory'
+    POST_FRAGMENT_CACHE_SIZE = int(os.environ.get('POST_FRAGMENT_CACHE_SIZE') or 10000)
+    POST_FRAGMENT_CACHE_DIR = os.environ.get('POST_FRAGMENT_CACHE_DIR')
 
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')  # required
     MS_TRANSLATOR_REGION = os.environ.get('MS_TRANSLATOR_REGION', 'uksouth')  
@@ -27,5 +81,27 @@ class Config:
         'MS_TRANSLATOR_ENDPOINT',
         'https://api.cognitive.microsofttranslator.com'
     )
+    TRANSLATOR_TIMEOUT = float(os.environ.get('TRANSLATOR_TIMEOUT') or 5) # seconds
+    TRANSLATOR_POOL_SIZE = int(os.environ.get('TRANSLATOR_POOL_SIZE') or 10)
 
-    ELASTICSEARCH_URL = os.environ.get('ELASTIC_HOST') or os.environ.get('ELASTICSEARCH_URL')
\ No newline at end of file
+    ELASTICSEARCH_URL = os.environ.get('ELASTIC_HOST') or os.environ.get('ELASTICSEARCH_URL')
+    # calls give up after ELASTICSEARCH_TIMEOUT seconds; after
+    # ELASTICSEARCH_FAILURE_THRESHOLD failures in a row the circuit breaker sends
+    # searches to the fallback for ELASTICSEARCH_RESET_TIMEOUT seconds, or until a
+    # background health check (every ELASTICSEARCH_HEALTH_INTERVAL seconds) succeeds
+    ELASTICSEARCH_TIMEOUT = float(os.environ.get('ELASTICSEARCH_TIMEOUT') or 5)
+    ELASTICSEARCH_FAILURE_THRESHOLD = int(os.environ.get('ELASTICSEARCH_FAILURE_THRESHOLD') or 3)
+    ELASTICSEARCH_RESET_TIMEOUT = int(os.environ.get('ELASTICSEARCH_RESET_TIMEOUT') or 30)
+    ELASTICSEARCH_HEALTH_INTERVAL = int(os.environ.get('ELASTICSEARCH_HEALTH_INTERVAL') or 10)
+    # SQLite FTS5 index used when Elasticsearch is missing or down
+    SEARCH_LOCAL_INDEX = os.environ.get('SEARCH_LOCAL_INDEX', '1') == '1'
+    # queued index changes are sent in bulk requests of up to SEARCH_OUTBOX_BATCH documents
+    SEARCH_OUTBOX_BATCH = int(os.environ.get('SEARCH_OUTBOX_BATCH') or 500)
+    SEARCH_OUTBOX_INTERVAL = int(os.environ.get('SEARCH_OUTBOX_INTERVAL') or 5)
+    # Elasticsearch results are fetched SEARCH_PREFETCH_PAGES pages at a time and
+    # cached per query for SEARCH_CACHE_TTL seconds, which is also how long a point
+    # in time serves new queries; hit totals are counted up to SEARCH_TRACK_TOTAL_HITS only
+    SEARCH_PREFETCH_PAGES = int(os.environ.get('SEARCH_PREFETCH_PAGES') or 10)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 60)
+    SEARCH_TRACK_TOTAL_HITS = int(os.environ.get('SEARCH_TRACK_TOTAL_HITS') or 1000)
+    SEARCH_PIT_KEEP_ALIVE = os.environ.get('SEARCH_PIT_KEEP_ALIVE') or '1m'
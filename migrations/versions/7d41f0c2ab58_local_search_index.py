@@ -0,0 +1,31 @@
+"""local search index
+
+Revision ID: 7d41f0c2ab58
+Revises: e2a5c7f09b14
+Create Date: 2026-10-18 12:40:06.912385
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d41f0c2ab58'
+down_revision = 'e2a5c7f09b14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # FTS5 is SQLite only, other databases keep the LIKE fallback
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5("
+               "body, tokenize='unicode61 remove_diacritics 2')")
+    op.execute('INSERT INTO post_fts (rowid, body) SELECT id, body FROM post')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TABLE IF EXISTS post_fts')
@@ -17,6 +17,15 @@ with app.app_context():
   print("db.create_all() done")
 PY
 
+# WAL, tuned pragmas and a per-worker writer lock for the default SQLite database
+if [ -z "$DATABASE_URL" ]; then
+  export SQLITE_PROFILE="${SQLITE_PROFILE:-production}"
+fi
+
+# gunicorn workers publish their /metrics histograms through snapshot files
+export METRICS_DIR="${METRICS_DIR:-/tmp/microblog-metrics}"
+rm -rf "$METRICS_DIR"
+
 echo "==> Starting Gunicorn..."
 exec gunicorn -w 2 -k gthread --threads 8 -b 0.0.0.0:${PORT} microblog:app
 # or: "app:create_app()" if you don't have microblog.py
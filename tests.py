@@ -1,7 +1,38 @@
 from datetime import datetime, timezone, timedelta
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import types
 import unittest
-from app import create_app, db
-from app.models import User, Post
+import elasticsearch
+import sqlalchemy as sa
+from aiosmtpd.controller import Controller
+from flask import Response, template_rendered
+from app import create_app, db, mail
+from app.models import User, Post, SearchOutbox, EmailOutbox, Translation, timeline
+from app.search import drain_outbox, query_index
+from app.circuit import CircuitOpen, ElasticsearchClient
+from app.email import send_email, drain_outbox as drain_mail
+from app.language import detect_languages
+from app import translate as translate_module
+from app.translate import translate
+from app.pagination import keyset_paginate
+from app.recent import RecentPosts
+from app import bench
+from app.metrics import external_call
+from app.querycount import QueryCounter, TooManyQueries
+from app.sqlite import WriterLock
+from app.session_user import SessionUser, UserSnapshot
+from app.streaming import after_body
 
 from config import Config
 
@@ -9,6 +40,163 @@ from config import Config
 class TestConfig(Config):
     TESTING = True # tells Flask youre in test mode
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQL_QUERY_LIMIT = 10 # fail any request issuing more statements than this
+    BACKGROUND_WORKERS = False
+    RECENT_POSTS_SEQUENCE_FILE = os.path.join(tempfile.mkdtemp(), 'recent_posts.seq')
+
+class FakeIndices:
+    def __init__(self):
+        self.indices = {'post': {}}
+        self.aliases = {}
+        self.alias_actions = []
+
+    def exists(self, index):
+        return index in self.indices
+
+    def create(self, index):
+        self.indices[index] = {}
+
+    def get_mapping(self, index):
+        return {index: {'mappings': {'_meta': self.indices[index].get('meta', {})}}}
+
+    def put_mapping(self, index, meta):
+        self.indices[index]['meta'] = meta
+
+    def put_settings(self, index, settings):
+        self.indices[index]['refresh'] = settings['index']['refresh_interval']
+
+    def refresh(self, index):
+        pass
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return {self.aliases[name]: {}}
+
+    def update_aliases(self, actions):
+        self.alias_actions.extend(actions)
+
+
+# local stand-in for the Microsoft translator API, answers "<to>:<text>"
+class TranslatorStub(ThreadingHTTPServer):
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(handler):
+                query = parse_qs(urlsplit(handler.path).query)
+                texts = json.loads(handler.rfile.read(int(handler.headers['Content-Length'])))
+                self.requests.append((query, texts))
+                time.sleep(self.delay)
+                body = json.dumps([{'translations': [{'text': '{}:{}'.format(
+                    query['to'][0], item['Text'])}]} for item in texts]).encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'application/json')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+# local SMTP server recording messages and connections; addresses starting
+# with "bounce" are refused
+class SMTPStub:
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        self.controller = Controller(self, hostname='127.0.0.1', port=self.port)
+        self.controller.start()
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.connections += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith('bounce'):
+            return '550 no such user'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return '250 OK'
+
+    def stop(self):
+        if self.controller is not None:
+            self.controller.stop()
+            self.controller = None
+
+
+# what the client raises for an expired or closed point in time
+class PitMissing(Exception):
+    status_code = 404
+
+
+# records bulk requests in place of an Elasticsearch client
+class FakeElasticsearch:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.operations = []
+        self.indices = FakeIndices()
+        self.documents = {} # id -> body, for search()
+        self.searches = []
+        self.pits = 0
+        self.open_pits = set()
+
+    def open_point_in_time(self, index, keep_alive):
+        self.pits += 1
+        self.open_pits.add(f'{index}-pit-{self.pits}')
+        return {'id': f'{index}-pit-{self.pits}'}
+
+    def close_point_in_time(self, id):
+        self.open_pits.discard(id)
+
+    # scores by the number of matching words
+    def search(self, pit, query, sort, size, track_total_hits, search_after=None):
+        self.searches.append({'pit': pit['id'], 'sort': sort, 'size': size,
+                              'track_total_hits': track_total_hits, 'search_after': search_after})
+        if pit['id'] not in self.open_pits:
+            raise PitMissing(pit['id'])
+        words = query['multi_match']['query'].split()
+        hits = [{'_id': str(id), 'sort': [float(sum(body.split().count(w) for w in words)), id]}
+                for id, body in self.documents.items()]
+        descending = sort[0]['_score'] == 'desc'
+        hits = sorted((hit for hit in hits if hit['sort'][0]), key=lambda hit: hit['sort'],
+                      reverse=descending)
+        if search_after is not None:
+            hits = [hit for hit in hits if (hit['sort'] < search_after if descending
+                                            else hit['sort'] > search_after)]
+        return {'pit_id': pit['id'],
+                'hits': {'total': {'value': len(hits)}, 'hits': hits[:size]}}
+
+    def info(self):
+        if self.fail:
+            raise elasticsearch.ConnectionError('cluster unavailable')
+        return {'version': {'number': '9.0.0'}}
+
+    def bulk(self, operations):
+        if self.fail:
+            raise elasticsearch.ConnectionError('cluster unavailable')
+        self.operations.extend(operations)
+        return {'errors': False, 'items': [
+            {next(iter(op)): {'status': 200}} for op in operations
+            if 'index' in op or 'delete' in op]}
+
 
 class UserModelCase(unittest.TestCase):
     # run before each test, prepare a clean environment
@@ -35,6 +223,9 @@ class UserModelCase(unittest.TestCase):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'                                        '?d=identicon&s=128'))
+        # the stored digest follows email changes
+        u.email = 'Susan@Example.com'
+        self.assertEqual(u.avatar_hash, md5(b'susan@example.com').hexdigest())
 
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -101,6 +292,907 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline_pull_authors(self):
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u3)
+        u2.follow(u3)
+        db.session.commit()
+
+        # mary has more followers than the limit, so her post is not pushed
+        now = datetime.now(timezone.utc)
+        p1 = Post(body="post from john", author=u1, timestamp=now)
+        p2 = Post(body="post from mary", author=u3,
+                  timestamp=now + timedelta(seconds=1))
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertTrue(u3.timeline_pull)
+        pushed = db.session.scalars(
+            sa.select(timeline.c.user_id).where(timeline.c.post_id == p2.id)).all()
+        self.assertEqual(pushed, [u3.id])
+
+        self.assertEqual(db.session.scalars(u1.following_posts()).all(), [p2, p1])
+        self.assertEqual(db.session.scalars(u2.following_posts()).all(), [p2])
+        # the page validator finds the pulled post too, in one statement
+        with QueryCounter() as queries:
+            newest = u1.timeline_latest()
+            latest = db.session.execute(sa.select(newest.c.post_id).order_by(
+                newest.c.timestamp.desc()).limit(1)).scalar()
+        self.assertEqual((latest, queries.count), (p2.id, 1))
+        u2.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u2.following_posts()).all(), [])
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p = Post(body='post from john', author=u1)
+        db.session.add(p)
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual((u1.posts_count(), u1.followers_count()), (1, 1))
+        self.assertEqual(u2.following_count(), 1)
+
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(u1.posts_count(), 0)
+
+        db.session.execute(sa.update(User).values(num_followers=7, num_posts=3))
+        db.session.commit()
+        self.assertEqual(User.repair_counters(), 2)
+        self.assertEqual((u1.posts_count(), u1.followers_count()), (0, 1))
+        self.assertEqual((u2.posts_count(), u2.followers_count()), (0, 0))
+        self.assertEqual(User.repair_counters(), 0)
+
+    def test_last_seen_buffer(self):
+        u = User(username='john', email='john@example.com',
+                 last_seen=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        db.session.add(u)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+        # page views only buffer the update
+        with QueryCounter() as queries:
+            self.client.get('/explore')
+            self.client.get('/explore')
+        self.assertFalse(any(q.startswith('UPDATE') for q in queries.statements))
+        stored = db.session.scalar(sa.select(User.last_seen).where(User.id == u.id))
+        self.assertEqual(stored.year, 2020)
+
+        self.assertEqual(self.app.last_seen.flush(), 1)
+        stored = db.session.scalar(sa.select(User.last_seen).where(User.id == u.id))
+        self.assertGreater(stored.year, 2020)
+        # within LAST_SEEN_GRANULARITY nothing is recorded again
+        self.client.get('/explore')
+        self.assertEqual(self.app.last_seen.flush(), 0)
+        # not even for a session snapshot cached before the flush
+        snapshot = UserSnapshot(u)
+        snapshot.last_seen = datetime(2020, 1, 1)
+        self.app.last_seen.touch(SessionUser(snapshot))
+        self.assertEqual(self.app.last_seen.flush(), 0)
+
+    def test_session_user_cache(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+
+        # the first request loads the user, later ones read the snapshot
+        self.client.get('/explore')
+        with QueryCounter() as queries:
+            response = self.client.get('/user/susan')
+        self.assertIn(b'value="Follow"', response.data)
+        self.assertFalse(any('WHERE user.id = ?' in q for q in queries.statements))
+
+        # views that change the user load the row; the commit drops the snapshot
+        # and gives the session a new version
+        self.client.post('/follow/susan')
+        self.assertTrue(u1.is_following(u2))
+        self.client.post('/edit_profile', data={'username': 'johnny', 'about_me': 'hi'})
+        with self.client.session_transaction() as session:
+            version = session['_user_version']
+        self.assertIn(b'/user/johnny"', self.client.get('/explore').data)
+        self.assertIn(b'value="Unfollow"', self.client.get('/user/susan').data)
+
+        # changes committed outside a request of this user are picked up as well
+        u1.username = 'jon'
+        db.session.commit()
+        self.assertIn(b'/user/jon"', self.client.get('/explore').data)
+        with self.client.session_transaction() as session:
+            self.assertEqual(session['_user_version'], version)
+
+    def test_search_outbox(self):
+        self.app.elasticsearch = FakeElasticsearch(fail=True)
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='first', author=u)
+        p2 = Post(body='second', author=u)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        p1.body = 'first, edited'
+        db.session.delete(p2)
+        db.session.commit()
+        queued = db.session.scalars(sa.select(SearchOutbox.op)).all()
+        self.assertEqual(queued, ['index', 'index', 'index', 'delete'])
+
+        # a failed bulk request keeps the rows for a later retry
+        self.assertEqual(drain_outbox(), 0)
+        rows = db.session.scalars(sa.select(SearchOutbox)).all()
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(all(r.attempts == 1 and r.last_error for r in rows))
+
+        db.session.execute(sa.update(SearchOutbox).values(next_attempt=datetime(2000, 1, 1)))
+        db.session.commit()
+        self.app.elasticsearch = FakeElasticsearch()
+        self.assertEqual(drain_outbox(), 2)
+        self.assertEqual(self.app.elasticsearch.operations, [
+            {'index': {'_index': 'post', '_id': p1.id}}, {'body': 'first, edited'},
+            {'delete': {'_index': 'post', '_id': p2.id}}])
+        self.assertEqual(db.session.scalars(sa.select(SearchOutbox)).all(), [])
+
+    def test_elasticsearch_circuit_breaker(self):
+        self.app.config['ELASTICSEARCH_FAILURE_THRESHOLD'] = 2
+        fake = FakeElasticsearch(fail=True)
+        connects = []
+        es = ElasticsearchClient(self.app, 'http://search:9200',
+                                 factory=lambda: connects.append(1) or fake)
+        self.assertTrue(es)
+        self.assertEqual(connects, [])  # nothing until the first call
+
+        # errors of our own say nothing about the cluster
+        with self.assertRaises(TypeError):
+            es.bulk(unknown=1)
+        for i in range(2):
+            with self.assertRaises(elasticsearch.ConnectionError):
+                es.bulk(operations=[{'delete': {'_index': 'post', '_id': 1}}])
+        self.assertFalse(es)
+        fake.fail = False
+        with self.assertRaises(CircuitOpen):
+            es.bulk(operations=[{'delete': {'_index': 'post', '_id': 1}}])
+        self.assertEqual(fake.operations, [])
+        self.assertEqual(connects, [1])
+
+        # searches fall back to SQL without trying the cluster
+        self.app.elasticsearch = es
+        u = User(username='john', email='john@example.com')
+        db.session.add(Post(body='a cat', author=u))
+        db.session.commit()
+        self.assertEqual(query_index('post', 'cat', 10)[0], [1])
+        self.assertEqual(fake.searches, [])
+        # index changes are still queued for later
+        self.assertEqual(len(db.session.scalars(sa.select(SearchOutbox)).all()), 1)
+        metrics = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('microblog_circuit_open{service="elasticsearch"} 1', metrics)
+        # `if es:` being false counts as much as CircuitOpen
+        self.assertIn('microblog_circuit_rejected_total{service="elasticsearch"} 3', metrics)
+
+        # after the reset timeout one trial call goes through, success closes it
+        es.breaker.opened_at -= self.app.config['ELASTICSEARCH_RESET_TIMEOUT']
+        self.assertTrue(es)
+        self.assertTrue(es.indices.exists(index='post'))
+        self.assertEqual(es.breaker.state, 'closed')
+
+        # a failed health check counts like a failed call, a good one closes again
+        fake.fail = True
+        es.check()
+        es.check()
+        self.assertFalse(es)
+        fake.fail = False
+        es.check()
+        self.assertTrue(es)
+        self.assertEqual(drain_outbox(), 1)
+
+    def test_bulk_reindex(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([Post(body=f'post {i}', author=u) for i in range(5)])
+        db.session.commit()
+        es = self.app.elasticsearch = FakeElasticsearch()
+        progress = []
+        target, count = Post.reindex(chunk_size=2, concurrency=2, swap=True,
+                                     target='post_v2', progress=lambda *a: progress.append(a))
+        self.assertEqual((target, count), ('post_v2', 5))
+        self.assertEqual([p[:2] for p in progress], [(2, 2), (4, 4), (5, 5)])
+        self.assertEqual(len(es.operations), 10)
+        self.assertIsNone(es.indices.indices['post_v2']['refresh'])
+        self.assertEqual(es.indices.alias_actions, [
+            {'remove_index': {'index': 'post'}},
+            {'add': {'index': 'post_v2', 'alias': 'post'}}])
+
+        # resuming only sends rows after the recorded checkpoint
+        db.session.add(Post(body='late post', author=u))
+        db.session.commit()
+        es.operations = []
+        target, count = Post.reindex(target='post_v2', resume=True)
+        self.assertEqual(count, 1)
+        self.assertEqual(es.operations[1], {'body': 'late post'})
+
+    def test_search_paging(self):
+        es = self.app.elasticsearch = FakeElasticsearch()
+        self.app.config['SEARCH_PREFETCH_PAGES'] = 3
+        es.documents = {id: 'cat ' * (id % 3 + 1) for id in range(1, 13)}
+        ranking = sorted(es.documents, key=lambda id: (id % 3, id), reverse=True)
+
+        # six pages of two, fetched three pages per request
+        pages, cursor = [], None
+        while True:
+            ids, cursor, prev_cursor = query_index('post', 'cat', 2, cursor)
+            pages.append((ids, prev_cursor))
+            if cursor is None:
+                break
+        self.assertEqual([id for ids, _ in pages for id in ids], ranking)
+        self.assertEqual(len(es.searches), 2)
+        self.assertEqual(es.searches[1]['search_after'], [2.0, ranking[5]])
+        self.assertTrue(all(s['track_total_hits'] == 1000 for s in es.searches))
+
+        # back again: within a block from the cache, across blocks in reverse
+        ids, _, prev_cursor = query_index('post', 'cat', 2, pages[4][1])
+        self.assertEqual(ids, ranking[6:8])
+        self.assertEqual(len(es.searches), 2)
+        ids, _, prev_cursor = query_index('post', 'cat', 2, prev_cursor)
+        self.assertEqual(ids, ranking[4:6])
+        self.assertEqual(es.searches[-1]['sort'][0], {'_score': 'asc'})
+        ids, _, _ = query_index('post', 'cat', 2, prev_cursor)
+        self.assertEqual(ids, ranking[2:4])
+
+        # one point in time per index serves every query
+        self.assertEqual(query_index('post', 'cat cat', 2)[0], ranking[:2])
+        self.assertEqual(es.pits, 1)
+
+        # a cursor whose point in time expired starts over on a new one
+        es.open_pits.clear()
+        self.app.search_results.clear()
+        ids, cursor, _ = query_index('post', 'cat', 2, pages[3][1])
+        self.assertEqual(ids, ranking[:2])
+        self.assertEqual(es.pits, 2)
+        self.assertEqual(query_index('post', 'cat', 2, cursor)[0], ranking[2:4])
+
+        # replaced points in time are closed, all but the previous one
+        self.app.config['SEARCH_CACHE_TTL'] = 0
+        for i in range(3):
+            self.app.search_pits.get(es, 'post')
+        self.assertEqual(es.open_pits, {'post-pit-4', 'post-pit-5'})
+
+        # posts come back from one IN query in the order of the index
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([Post(id=id, body='cat ' * (id % 3 + 1), author=u)
+                            for id in es.documents])
+        db.session.commit()
+        self.app.search_results.clear()
+        posts, _, _ = Post.search('cat', 4)
+        self.assertEqual([p.id for p in posts], ranking[:4])
+
+    def test_local_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the cat sat on the mat', author=u)
+        p2 = Post(body='cat cat cat', author=u)
+        p3 = Post(body='a dog', author=u)
+        p4 = Post(body='dogs and cats', author=u)
+        db.session.add_all([p1, p2, p3, p4])
+        db.session.commit()
+
+        # bm25 puts the denser match first, and paging follows the ranking
+        posts, next_cursor, prev_cursor = Post.search('cat', 1)
+        self.assertEqual(list(posts), [p2])
+        self.assertIsNone(prev_cursor)
+        posts, next_cursor, prev_cursor = Post.search('cat', 1, next_cursor)
+        self.assertEqual(list(posts), [p1])
+        self.assertIsNone(next_cursor)
+        posts, _, _ = Post.search('cat', 1, prev_cursor)
+        self.assertEqual(list(posts), [p2])
+
+        # edits and deletes reach the index in the same transaction
+        p3.body = 'a cat'
+        db.session.delete(p2)
+        db.session.commit()
+        posts, _, _ = Post.search('cat OR "', 10)
+        self.assertEqual(sorted(p.id for p in posts), [p1.id, p3.id])
+
+    def test_translation_cache(self):
+        stub = TranslatorStub(delay=0.2)
+        self.addCleanup(stub.shutdown)
+        self.app.config.update(MS_TRANSLATOR_KEY='key', MS_TRANSLATOR_ENDPOINT=stub.url)
+        translate_module._memory.clear()
+
+        # concurrent identical requests make a single upstream call
+        results = []
+        def worker():
+            with self.app.app_context():
+                results.append(translate('hola', 'es', 'en'))
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ['en:hola'] * 5)
+        self.assertEqual(len(stub.requests), 1)
+        self.assertEqual(stub.requests[0][0]['from'], ['es'])
+
+        # the database level survives a cold worker cache
+        translate_module._memory.clear()
+        self.assertEqual(translate('hola', 'es', 'en'), 'en:hola')
+        self.assertEqual(translate('hola', 'es', 'zh_Hans'), 'zh_Hans:hola')
+        self.assertEqual(len(stub.requests), 2)
+
+        # stored on a connection of its own: a key stored already is skipped alone,
+        # and the caller's pending changes are neither committed nor discarded
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        key = translate_module.translation_key('hola', 'es', 'en')
+        translate_module._store({key: 'other', 'new-key': 'text'}, 'es', 'en')
+        self.assertIn(u, db.session.new)
+        db.session.rollback()
+        self.assertIsNone(db.session.scalar(sa.select(User)))
+        self.assertEqual(db.session.get(Translation, key).text, 'en:hola')
+        self.assertEqual(db.session.get(Translation, 'new-key').text, 'text')
+
+    def test_translate_posts(self):
+        stub = TranslatorStub()
+        self.addCleanup(stub.shutdown)
+        self.app.config.update(MS_TRANSLATOR_KEY='key', MS_TRANSLATOR_ENDPOINT=stub.url)
+        translate_module._memory.clear()
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body='hola', author=u, language='es'),
+                 Post(body='adios', author=u, language='es'),
+                 Post(body='ni hao', author=u, language='zh'),
+                 Post(body='hello', author=u, language='en')]
+        db.session.add_all(posts)
+        db.session.commit()
+        translate('hola', 'es', 'en')
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+        response = self.client.post('/translate/posts', json={
+            'post_ids': [p.id for p in posts], 'dest_language': 'en'})
+        self.assertEqual(response.get_json()['translations'], {
+            str(posts[0].id): 'en:hola', str(posts[1].id): 'en:adios',
+            str(posts[2].id): 'en:ni hao'})
+        # one array request per source language, cached texts are not resent
+        self.assertEqual(sorted(texts[0]['Text'] for query, texts in stub.requests[1:]),
+                         ['adios', 'ni hao'])
+        for body in ({'post_ids': [posts[0].id]}, {'post_ids': ['x'], 'dest_language': 'en'},
+                     {'post_ids': [None], 'dest_language': 'en'}, ['en']):
+            response = self.client.post('/translate/posts', json=body)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('message', response.get_json())
+
+    def test_language_detection(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+        # with background workers off the detector runs inline after the commit
+        self.client.post('/index', data={'post': 'This is a post written in plain English'})
+        post = db.session.scalar(sa.select(Post))
+        self.assertEqual(post.language, 'en')
+
+        # an already detected language is never overwritten
+        self.app.language_detector.fill(post.id, 'Esto es un texto escrito en castellano')
+        db.session.refresh(post)
+        self.assertEqual(post.language, 'en')
+
+        self.assertEqual(detect_languages([(1, '12345'), (2, 'Bonjour tout le monde, comment allez-vous')]),
+                         [(1, ''), (2, 'fr')])
+
+    def test_post_fragments(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='post from john', author=u, timestamp=datetime.now(timezone.utc))
+        db.session.add_all([u, p])
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        rendered = []
+        def record(sender, template, context, **extra):
+            if template.name == '_post.html':
+                rendered.append(context['post'].id)
+        template_rendered.connect(record, self.app)
+        self.addCleanup(template_rendered.disconnect, record, self.app)
+
+        self.client.get('/explore').get_data()
+        self.client.get('/explore').get_data()
+        self.assertEqual(rendered, [p.id])
+        # the stamp changes with the author's name and with post edits
+        u.username = 'johnny'
+        db.session.commit()
+        self.assertIn(b'johnny', self.client.get('/explore').data)
+        p.body = 'edited'
+        db.session.commit()
+        self.assertEqual(p.version, 2)
+        self.assertIn(b'edited', self.client.get('/explore').data)
+        self.assertEqual(rendered, [p.id] * 3)
+        # and entries of deleted posts are dropped
+        db.session.delete(p)
+        db.session.commit()
+        self.assertIsNone(self.app.post_fragments.backend.get(f'post:{p.id}:en'))
+
+    def test_conditional_get(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2, Post(body='post from susan', author=u2)])
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+
+        for url in ('/explore', '/index', '/user/susan'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            with QueryCounter() as counter:
+                response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(response.data, b'')
+            # no pagination or rendering, just the validator lookups
+            self.assertLessEqual(counter.count, 3)
+
+        # Last-Modified is held back during the second of the last change; from
+        # the buffer, then from the database
+        size = self.app.recent_posts.size
+        for buffered in (True, False):
+            self.app.recent_posts.size = size if buffered else 0
+            time.sleep(1)
+            ims = {'If-Modified-Since': self.client.get('/explore').headers['Last-Modified']}
+            self.assertEqual(self.client.get('/explore', headers=ims).status_code, 304)
+            # a rename is no new post, but the page changes
+            u2.username = 'susan2' if buffered else 'susan'
+            db.session.commit()
+            response = self.client.get('/explore', headers=ims)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(u2.username.encode(), response.data)
+        self.app.recent_posts.size = size
+        self.app.recent_posts.load()
+        explore = self.client.get('/explore')
+
+        # following changes the home page, a new post changes all of them
+        index = self.client.get('/index').headers['ETag']
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(self.client.get('/index', headers={'If-None-Match': index}).status_code, 200)
+        db.session.add(Post(body='another post', author=u2))
+        db.session.commit()
+        self.assertEqual(self.client.get('/explore', headers={
+            'If-None-Match': explore.headers['ETag']}).status_code, 200)
+
+        # pending flashed messages are always rendered
+        etag = self.client.get('/explore').headers['ETag']
+        with self.client.session_transaction() as session:
+            session['_flashes'] = [('message', 'hello')]
+        response = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'hello', response.data)
+        self.assertNotIn('ETag', response.headers)
+
+    def test_conditional_get_content_changes(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        p = Post(body='Esto es un texto escrito en castellano', author=u2)
+        db.session.add_all([u1, u2, p])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+
+        def changed(urls, etags):
+            return [self.client.get(url, headers={'If-None-Match': etag}).status_code
+                    for url, etag in zip(urls, etags)]
+        urls = ['/explore', '/index', '/user/susan']
+        self.client.get('/index')  # the form's CSRF token is part of the ETag
+        etags = [self.client.get(url).headers['ETag'] for url in urls]
+        self.assertEqual(changed(urls, etags), [304, 304, 304])
+
+        # the viewer's name is in the navbar
+        self.client.post('/edit_profile', data={'username': 'johnny', 'about_me': ''})
+        self.assertEqual(changed(urls, etags), [200, 200, 200])
+
+        # so are author names and avatars next to every post
+        etags = [self.client.get(url).headers['ETag'] for url in urls[:2]]
+        u2.email = 'susan@example.org'
+        db.session.commit()
+        self.assertEqual(changed(urls[:2], etags), [200, 200])
+
+        # and the Translate link, once the language is detected
+        etags = [self.client.get(url).headers['ETag'] for url in urls]
+        self.app.language_detector.fill(p.id, p.body)
+        self.assertEqual(changed(urls, etags), [200, 200, 200])
+
+        # also when they are filled in by the backfill command
+        db.session.add(Post(body='Dies ist ein Text, der auf Deutsch geschrieben ist', author=u2))
+        db.session.commit()
+        etags = [self.client.get(url).headers['ETag'] for url in urls]
+        result = self.app.test_cli_runner().invoke(
+            args=['language', 'backfill', '--processes', '1'])
+        self.assertIn('1 posts updated', result.output)
+        self.assertEqual(changed(urls, etags), [200, 200, 200])
+
+    def test_email_outbox(self):
+        smtp = SMTPStub()
+        self.addCleanup(smtp.stop)
+        self.app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=smtp.port,
+                               MAIL_SUPPRESS_SEND=False)
+        self.app.extensions['mail'] = mail.init_mail(self.app.config)
+
+        for to in ('a@example.com', 'bounce@example.com', 'b@example.com'):
+            send_email('hi', 'admin@example.com', [to], 'text', '<p>html</p>')
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count(EmailOutbox.id))), 3)
+
+        # one connection for the batch, the refused message is set aside
+        self.assertEqual(drain_mail(), 2)
+        self.assertEqual(smtp.connections, 1)
+        self.assertEqual(sorted(m.rcpt_tos[0] for m in smtp.messages),
+                         ['a@example.com', 'b@example.com'])
+        row = db.session.scalar(sa.select(EmailOutbox))
+        self.assertEqual((row.recipients, row.attempts), (['bounce@example.com'], 1))
+        self.assertIsNotNone(row.failed_at)
+        self.assertIsNotNone(row.last_error)
+        row.next_attempt = datetime.now(timezone.utc) - timedelta(seconds=1)
+        db.session.commit()
+        self.assertEqual(drain_mail(), 0) # not retried
+
+        # a message that cannot be built is dead-lettered too, not leased forever
+        send_email('hi\nBcc: everyone@example.com', 'admin@example.com', ['d@example.com'],
+                   'text', '<p>html</p>')
+        self.assertEqual(drain_mail(), 0)
+        row = db.session.scalar(sa.select(EmailOutbox).order_by(EmailOutbox.id.desc()).limit(1))
+        self.assertEqual(row.attempts, 1)
+        self.assertIsNotNone(row.failed_at)
+
+        # a dead server leaves the batch for later
+        smtp.stop()
+        send_email('hi', 'admin@example.com', ['c@example.com'], 'text', '<p>html</p>')
+        self.assertEqual(drain_mail(), 0)
+        row = db.session.scalar(sa.select(EmailOutbox).where(EmailOutbox.failed_at.is_(None)))
+        self.assertEqual((row.attempts, row.failed_at), (1, None))
+
+    def test_metrics(self):
+        self.app.add_url_rule('/boom', 'boom', lambda: 1 / 0)
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Post(body='post from john', author=u)])
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        self.app.config['METRICS_SLOW_REQUEST'] = 0.000001
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get('/explore').get_data()
+        self.assertIn('main.explore', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+        # failures are measured too
+        with self.assertRaises(ZeroDivisionError):
+            self.client.get('/boom')
+        with self.assertRaises(OSError), external_call('smtp'):
+            raise OSError('connection refused')
+
+        # another worker's snapshot is added in, a dead worker's is dropped
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config['METRICS_DIR'] = directory
+        other = {'microblog_request_duration_seconds': {'main.explore\tok': [0] * 11 + [1, 20.0, 1]}}
+        with open(os.path.join(directory, '1.json'), 'w') as f:
+            json.dump(other, f)
+        gone = subprocess.Popen(['true'])
+        gone.wait()
+        with open(os.path.join(directory, f'{gone.pid}.json'), 'w') as f:
+            json.dump(other, f)
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('# TYPE microblog_request_duration_seconds histogram', text)
+        self.assertIn('microblog_request_duration_seconds_count'
+                      '{endpoint="main.explore",outcome="ok"} 2', text)
+        self.assertIn('microblog_request_duration_seconds_bucket'
+                      '{endpoint="main.explore",outcome="ok",le="+Inf"} 2', text)
+        self.assertIn('microblog_request_duration_seconds_count'
+                      '{endpoint="boom",outcome="error"} 1', text)
+        self.assertIn('microblog_external_call_seconds_count'
+                      '{service="smtp",outcome="error"} 1', text)
+        self.assertEqual(os.listdir(directory), ['1.json'])
+        # explore's posts come from the recent posts buffer, one statement to fill it
+        self.assertRegex(text, r'microblog_request_sql_statements_bucket'
+                               r'\{endpoint="main.explore",le="1"\} 1')
+        self.assertIn('microblog_request_template_seconds_count{endpoint="main.explore"} 1', text)
+
+    def test_bench(self):
+        users, follows, posts = bench.seed(users=30, posts=200, follows=5)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count(Post.id))), 200)
+        self.assertEqual(User.repair_counters(), 0) # counters already rebuilt
+        self.assertEqual(db.session.scalar(sa.select(sa.func.sum(User.num_following))), follows)
+        # each post reaches its author and every follower
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(timeline)),
+                         posts + db.session.scalar(sa.select(sa.func.sum(User.num_followers * User.num_posts))))
+
+        report = bench.run(requests=3, warmup=1, memory_requests=1)
+        self.assertEqual(set(report['routes']), {'index', 'index_page_2', 'explore', 'user',
+                                                 'search', 'follow_unfollow'})
+        self.assertLessEqual(report['routes']['explore']['max_queries'], 6)
+        self.assertEqual(bench.regressions(report, report), [])
+        slower = {'routes': {'index': dict(report['routes']['index'], p95_ms=0, max_queries=1)}}
+        self.assertEqual(len(bench.regressions(report, slower)), 2)
+
+    def test_read_replica(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'primary.db')
+            SQLALCHEMY_BINDS = {'replica0': 'sqlite:///' + os.path.join(directory, 'replica.db')}
+            WTF_CSRF_ENABLED = False
+            RECENT_POSTS_SIZE = 0 # explore reads the database
+        app = create_app(ReplicaConfig)
+        with app.app_context():
+            db.create_all()
+            db.metadata.create_all(db.engines['replica0'])
+            # the "replica" lags behind: it has the user but not their post yet
+            with db.engines['replica0'].begin() as conn:
+                conn.execute(User.__table__.insert(), {
+                    'id': 1, 'username': 'john', 'email': 'john@example.com',
+                    'avatar_hash': '', 'num_followers': 0, 'num_following': 0,
+                    'num_posts': 0, 'follow_version': 0, 'timeline_pull': False})
+            u = User(id=1, username='john', email='john@example.com')
+            db.session.add_all([u, Post(body='primary post', author=u)])
+            db.session.commit()
+            engines = list(db.engines.values())
+        self.addCleanup(lambda: [engine.dispose() for engine in engines])
+        # binds add a metadata to the shared db object, don't leak it to other tests
+        db.metadatas.pop('replica0', None)
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = '1'
+        self.assertNotIn(b'primary post', client.get('/explore').data)
+        # writes go to the primary and pin the client to it for a while
+        client.post('/index', data={'post': 'new post'})
+        data = client.get('/explore').data
+        self.assertIn(b'new post', data)
+        self.assertIn(b'primary post', data)
+        with client.session_transaction() as session:
+            session['_db_sticky_until'] = 0
+        self.assertNotIn(b'new post', client.get('/explore').data)
+
+    def test_sqlite_profile(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        class SQLiteConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'app.db')
+            SQLITE_PROFILE = 'production'
+        app = create_app(SQLiteConfig)
+        with app.app_context():
+            db.create_all()
+            self.addCleanup(db.engine.dispose)
+            self.assertEqual(db.session.scalar(sa.text('PRAGMA journal_mode')), 'wal')
+            self.assertEqual(db.session.scalar(sa.text('PRAGMA synchronous')), 1) # NORMAL
+            db.session.rollback()
+
+        # concurrent writers queue on the per-process lock instead of failing
+        errors = []
+        def writer(i):
+            with app.app_context():
+                try:
+                    for j in range(10):
+                        db.session.add(User(username=f'u{i}-{j}', email=f'u{i}-{j}@example.com'))
+                        db.session.commit()
+                except Exception as e:
+                    errors.append(e)
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        with app.app_context():
+            self.assertEqual(db.session.scalar(sa.select(sa.func.count(User.id))), 80)
+            db.session.remove()
+
+        # a transaction that timed out on the lock waits once, not once per write
+        lock = WriterLock(timeout=0.2)
+        lock._lock.acquire()
+        conn = types.SimpleNamespace(info={})
+        start = time.monotonic()
+        for _ in range(3):
+            lock._before_cursor_execute(conn, None, 'UPDATE user SET about_me = ?', (), None, False)
+        self.assertLess(time.monotonic() - start, 0.4)
+        lock._end(conn)
+        self.assertEqual(conn.info, {})
+
+    def test_api(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u1.set_password('cat')
+        db.session.add_all([u1, u2])
+        now = datetime.now(timezone.utc)
+        db.session.add_all([Post(body=f'post {i} from susan', author=u2, language='en',
+                                 timestamp=now + timedelta(seconds=i)) for i in range(3)])
+        db.session.commit()
+
+        self.assertEqual(self.client.get('/api/explore').status_code, 401)
+        self.assertEqual(self.client.post('/api/tokens', auth=('john', 'dog')).status_code, 401)
+        token = self.client.post('/api/tokens', auth=('john', 'cat')).get_json()['token']
+        headers = {'Authorization': f'Bearer {token}'}
+
+        data = self.client.get('/api/explore?limit=2', headers=headers).get_json()
+        self.assertEqual([p['body'] for p in data['items']], ['post 2 from susan', 'post 1 from susan'])
+        # authors are sent once per page
+        self.assertEqual(data['authors'], {str(u2.id): {
+            'username': 'susan', 'avatar': f'https://www.gravatar.com/avatar/{u2.avatar_hash}?d=identicon'}})
+        data = self.client.get('/api/explore', headers=headers,
+                               query_string={'limit': 2, 'cursor': data['next_cursor']}).get_json()
+        self.assertEqual([p['body'] for p in data['items']], ['post 0 from susan'])
+        self.assertIsNone(data['next_cursor'])
+
+        self.assertEqual(self.client.get('/api/timeline', headers=headers).get_json()['items'], [])
+        response = self.client.post('/api/users/susan/follow', headers=headers)
+        self.assertEqual(response.get_json(), {'following': True, 'followers': 1})
+        with QueryCounter() as counter:
+            data = self.client.get('/api/timeline', headers=headers).get_json()
+        self.assertEqual(len(data['items']), 3)
+        self.assertLessEqual(counter.count, 4) # token, page, authors
+        self.assertEqual(len(self.client.get('/api/users/susan/posts', headers=headers)
+                             .get_json()['items']), 3)
+        self.assertEqual(self.client.get('/api/users/nobody/posts', headers=headers).status_code, 404)
+        data = self.client.get('/api/search?q=susan', headers=headers).get_json()
+        self.assertEqual(len(data['items']), 3)
+        self.client.delete('/api/users/susan/follow', headers=headers)
+        self.assertEqual(u1.following_count(), 0)
+
+        self.assertEqual(self.client.get('/api/nothing', headers=headers).get_json()['error'],
+                         'Not Found')
+        self.assertEqual(self.client.delete('/api/tokens', headers=headers).status_code, 204)
+        self.assertEqual(self.client.get('/api/explore', headers=headers).status_code, 401)
+
+    def test_keyset_paginate(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=u, timestamp=now + timedelta(seconds=i))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        key = (Post.timestamp, Post.id)
+
+        page1 = keyset_paginate(sa.select(Post), key, None, 2)
+        self.assertEqual(page1.items, [posts[4], posts[3]])
+        self.assertIsNone(page1.prev_cursor)
+        page2 = keyset_paginate(sa.select(Post), key, page1.next_cursor, 2)
+        self.assertEqual(page2.items, [posts[2], posts[1]])
+        page3 = keyset_paginate(sa.select(Post), key, page2.next_cursor, 2)
+        self.assertEqual(page3.items, [posts[0]])
+        self.assertIsNone(page3.next_cursor)
+
+        back = keyset_paginate(sa.select(Post), key, page3.prev_cursor, 2)
+        self.assertEqual(back.items, page2.items)
+        back = keyset_paginate(sa.select(Post), key, back.prev_cursor, 2)
+        self.assertEqual(back.items, page1.items)
+        self.assertIsNone(back.prev_cursor)
+        self.assertEqual(keyset_paginate(sa.select(Post), key, 'garbage', 2).items,
+                         page1.items)
+
+    def test_post_list_queries(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(25)]
+        db.session.add_all(users)
+        db.session.commit()
+        db.session.add_all([Post(body=f'post {i}', author=u) for i, u in enumerate(users)])
+        for u in users[1:]:
+            users[0].follow(u)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(users[0].id)
+        self.app.recent_posts.start()  # done by the worker's first request
+
+        # authors are batch loaded, so the count does not grow with the page
+        for url in ('/index', '/explore', '/search?q=post'):
+            with QueryCounter() as queries:
+                response = self.client.get(url)
+                response.get_data()
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(queries.count, 6, url)
+
+        self.app.config['SQL_QUERY_LIMIT'] = 1
+        with self.assertRaises(TooManyQueries):
+            self.client.get('/index').get_data()
+
+    def test_after_body(self):
+        calls = []
+        after_body(Response(b'page'), lambda: calls.append('buffered'))
+        self.assertEqual(calls, ['buffered'])
+        response = after_body(Response(iter([b'head', b'posts'])), lambda: calls.append('streamed'))
+        self.assertEqual(next(response.iter_encoded()), b'head')
+        self.assertEqual(calls, ['buffered'])
+        # the client disconnected, the server closes the body
+        response.close()
+        self.assertEqual(calls, ['buffered', 'streamed'])
+
+    def test_streamed_pages(self):
+        self.app.config['POSTS_PER_PAGE'] = 5
+        self.app.config['POSTS_STREAM_BATCH'] = 2
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        db.session.add_all([Post(body=f'post {i}', author=u, timestamp=now + timedelta(seconds=i))
+                            for i in range(12)])
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        self.app.recent_posts.start()
+
+        with QueryCounter() as queries:
+            response = self.client.get('/index')
+            self.assertTrue(response.is_streamed)
+            chunks = response.iter_encoded()
+            # the head goes out before the posts are fetched
+            self.assertIn(b'<html', next(chunks))
+            self.assertFalse(any('post.body' in q for q in queries.statements))
+            page = b''.join(chunks).decode()
+        self.assertEqual(re.findall(r'post (\d+)', page), ['11', '10', '9', '8', '7'])
+        # six rows (one to look ahead) in batches of two, authors loaded per batch
+        self.assertEqual(sum('WHERE user.id IN' in q for q in queries.statements), 3)
+
+        # the pagination links are filled in after the posts
+        older = re.search(r'href="(/index\?cursor=[^"]+)"', page).group(1)
+        page = self.client.get(older).get_data(as_text=True)
+        self.assertEqual(re.findall(r'post (\d+)', page), ['6', '5', '4', '3', '2'])
+        newer = re.search(r'href="(/index\?cursor=[^"]+)"', page).group(1)
+        page = self.client.get(newer).get_data(as_text=True)
+        self.assertEqual(re.findall(r'post (\d+)', page), ['11', '10', '9', '8', '7'])
+        self.assertEqual(len(re.findall(r'href="/index\?cursor=', page)), 1)
+
+    def test_recent_posts(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        db.session.add_all([Post(body=f'post {i}', author=u, timestamp=now + timedelta(seconds=i))
+                            for i in range(30)])
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        self.client.get('/explore').get_data() # fills the buffer
+
+        def explore(url='/explore'):
+            with QueryCounter() as queries:
+                page = self.client.get(url).get_data(as_text=True)
+            return (re.findall(r'post (\d+)', page),
+                    [q for q in queries.statements if 'FROM post' in q], page)
+
+        ids, queries, page = explore()
+        self.assertEqual(ids, [str(i) for i in range(29, 4, -1)])
+        self.assertEqual(queries, [])
+        older = re.search(r'href="(/explore\?cursor=[^"]+)"', page).group(1)
+        ids, queries, page = explore(older)
+        self.assertEqual(ids, ['4', '3', '2', '1', '0'])
+        self.assertEqual(queries, [])
+        self.assertNotIn('Older posts</a>', page.replace('\n', '').replace(' ', ''))
+
+        # commits in this process update the buffer in place
+        db.session.add(Post(body='post 30', author=u, timestamp=now + timedelta(seconds=30)))
+        db.session.commit()
+        db.session.delete(db.session.scalar(sa.select(Post).where(Post.body == 'post 29')))
+        u.username = 'johnny'
+        db.session.commit()
+        ids, queries, page = explore()
+        self.assertEqual(ids[:3], ['30', '28', '27'])
+        self.assertEqual(queries, [])
+        self.assertIn('/user/johnny', page)
+
+        # another worker wrote: the sequence moved on, the buffer is reloaded once
+        other = RecentPosts(self.app)
+        other.apply([('delete', 1)])
+        self.assertEqual(len(explore()[1]), 1)
+        self.assertEqual(explore()[1], [])
+
+        # pages past a smaller buffer come from the database
+        self.app.recent_posts.size = 10
+        self.app.recent_posts.load()
+        ids, queries, page = explore()
+        self.assertEqual(ids, ['30'] + [str(i) for i in range(28, 4, -1)])
+        self.assertEqual(len(queries), 1)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file